@@ -36,6 +36,18 @@ BLOCK_SURVEY = False
 
 BLOCK_REPORTS = False
 
+# Number of reports each process keeps in memory in front of the report cache collection
+REPORT_MEMORY_CACHE_SIZE = 100
+
+# Keep serving the previous version of an invalidated report while a new one is computed in the background
+REPORT_STALE_WHILE_REVALIDATE = False
+
+# Changes younger than this are left out of /data/changes, earlier sequence numbers may still be being written
+OPEN_DATA_CHANGES_DELAY_SECONDS = 2
+
+# Where public exports and open data dumps are kept: "local" (a directory per node) or "gridfs" (shared by all nodes)
+ARTIFACT_STORE = "local"
+
 ANALYTICS_ENABLED = False
 
 TEMPLATE_CONTEXT_PROCESSORS = TCP + (
@@ -5,7 +5,7 @@ from django.contrib.auth.views import logout
 
 from django.contrib import admin
 import libstat
-from libstat.apis.open_data import data_api, observation_api, export_api
+from libstat.apis.open_data import data_api, changes_api, observation_api, dump_api, export_api
 from libstat.apis.terms import term_api, terms_api
 
 from libstat.views.auth import login
@@ -44,6 +44,8 @@ urlpatterns = patterns('',
 
     # APIs
     url(r'^data$', data_api, name="data_api"),
+    url(r'^data/changes$', changes_api, name="changes_api"),
+    url(r'^data/dump/(?P<year>\d{4})\.(?P<dump_format>ndjson|csv)$', dump_api, name="dump_api"),
     url(r'^data/(?P<observation_id>\w+)$', observation_api, name="observation_api"),
     url(r'^def/terms$', terms_api, name="terms_api"),
     url(r'^def/terms/(?P<term_key>\w+)$', term_api, name="term_api"),
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+from django.views.decorators.http import condition
+
+
+def api_condition(validators_func):
+    """
+        Answers conditional GETs of an API view with 304 Not Modified before the view is run, see
+        django.views.decorators.http.condition. 'validators_func' is called with the arguments of the view and
+        returns (last modification, version) of the data of the response, or None when there is no data to
+        validate. The ETag is made from both, the path and the query parameters.
+    """
+    def validators(request, *args, **kwargs):
+        if not hasattr(request, "_api_validators"):
+            request._api_validators = validators_func(request, *args, **kwargs)
+        return request._api_validators
+
+    def etag(request, *args, **kwargs):
+        current = validators(request, *args, **kwargs)
+        if current is None:
+            return None
+        return hashlib.sha1(repr((current, request.path, sorted(request.GET.lists())))).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        current = validators(request, *args, **kwargs)
+        return current[0] if current else None
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+def last_modified(objects):
+    """
+        The latest date_modified of a query set, read from the first document in date_modified order.
+    """
+    for document in objects.order_by("-date_modified").only("date_modified").limit(1).as_pymongo():
+        return document.get("date_modified")
+    return None
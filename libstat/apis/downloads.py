@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import re
+from calendar import timegm
+
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+
+from libstat.services.artifact_store import open_artifact, CHUNK_SIZE
+
+
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header, size):
+    """
+        Returns the inclusive (first, last) byte positions of a Range header with a single byte range, or None
+        for headers that are ignored. Raises ValueError when the range is not satisfiable.
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last bytes of the file
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError(u"Unsatisfiable range {} for {} bytes".format(header, size))
+    return first, last
+
+
+def accepts_gzip(request):
+    """
+        Whether the Accept-Encoding header of a request gives gzip, or else '*', a q-value above 0.
+    """
+    qualities = {}
+    for coding in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        parameters = [parameter.strip() for parameter in coding.split(";")]
+        quality = 1.0
+        for parameter in parameters[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[parameters[0].lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def _read(stored, length):
+    try:
+        while length > 0:
+            chunk = stored.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        stored.close()
+
+
+def _is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match:
+        return etag in parse_etags(if_none_match) or "*" in parse_etags(if_none_match)
+    if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return bool(if_modified_since) and last_modified <= if_modified_since
+
+
+def artifact_response(request, artifact, content_type):
+    """
+        Streams a stored artifact with Content-Length and an ETag made from its checksum. Conditional requests
+        are answered with 304 and a single byte range with 206, also when an If-Range header still matches.
+    """
+    etag = artifact.checksum
+    last_modified = timegm(artifact.date_created.utctimetuple())
+    if _is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        byte_range = None
+        if_range = request.META.get("HTTP_IF_RANGE")
+        if "HTTP_RANGE" in request.META and (not if_range or if_range in (quote_etag(etag), http_date(last_modified))):
+            try:
+                byte_range = parse_byte_range(request.META["HTTP_RANGE"], artifact.size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */{}".format(artifact.size)
+                return response
+
+        stored = open_artifact(artifact)
+        if byte_range:
+            first, last = byte_range
+            stored.seek(first)
+            response = StreamingHttpResponse(_read(stored, last - first + 1), status=206, content_type=content_type)
+            response["Content-Range"] = "bytes {}-{}/{}".format(first, last, artifact.size)
+            response["Content-Length"] = last - first + 1
+        else:
+            response = StreamingHttpResponse(_read(stored, artifact.size), content_type=content_type)
+            response["Content-Length"] = artifact.size
+        response["Accept-Ranges"] = "bytes"
+
+    response["ETag"] = quote_etag(etag)
+    response["Last-Modified"] = http_date(last_modified)
+    return response
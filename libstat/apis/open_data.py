@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
+import base64
 import datetime
+import gzip
 import json
 import logging
+import urllib
 from time import strftime
 
-from django.http import HttpResponse, Http404, HttpResponseBadRequest, HttpResponseNotFound
+from django.http import HttpResponse, Http404, HttpResponseBadRequest, HttpResponseNotFound, StreamingHttpResponse
 from django.core.servers.basehttp import FileWrapper
 from mongoengine import Q
 from openpyxl.writer.excel import save_virtual_workbook
 
+from bson import ObjectId
+from bson.errors import InvalidId
+
 from bibstat import settings
-from libstat.models import Variable, OpenData
-from libstat.services.excel_export import public_excel_workbook
+from libstat.apis.conditional import api_condition, last_modified
+from libstat.apis.downloads import artifact_response, accepts_gzip
+from libstat.models import OpenData, OpenDataChange, Generation, variable_registry
+from libstat.services.artifact_store import open_artifact
+from libstat.services.excel_export import public_export_artifact
+from libstat.services.open_data_dump import DUMP_FORMATS, dump_artifact, has_open_data
 from libstat.utils import parse_datetime_from_isodate_str
 
 logger = logging.getLogger(__name__)
@@ -42,61 +52,213 @@ data_set = {
     u"label": u"Sveriges biblioteksstatistik"
 }
 
-def data_api(request):
+AFTER_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# Larger pages are streamed instead of built in memory
+DATA_API_STREAMING_LIMIT = 1000
+DATA_API_CHUNK_SIZE = 100
+# Query parameters kept in the next link of /data
+DATA_API_FILTERS = ("from_date", "to_date", "term", "sample_year", "sigel", "target_group")
+
+
+def encode_after(date_modified, object_id):
+    """
+        Opaque token for the position after an observation in the (-date_modified, -id) order of /data.
+    """
+    return base64.urlsafe_b64encode("{}|{}".format(date_modified.strftime(AFTER_DATE_FORMAT), object_id))
+
+
+def decode_after(token):
+    """
+        Returns the (date_modified, id) encoded by 'encode_after', raises ValueError for invalid tokens.
+    """
+    try:
+        date_modified, object_id = base64.urlsafe_b64decode(str(token)).split("|")
+        return datetime.datetime.strptime(date_modified, AFTER_DATE_FORMAT), ObjectId(object_id)
+    except (TypeError, InvalidId, UnicodeEncodeError):
+        raise ValueError(u"Invalid after token {}".format(token))
+
+
+def after_query(token):
+    date_modified, object_id = decode_after(token)
+    return Q(date_modified__lt=date_modified) | Q(date_modified=date_modified, id__lt=object_id)
+
+
+def _modified_dates(request):
     from_date = parse_datetime_from_isodate_str(request.GET.get("from_date", None))
     to_date = parse_datetime_from_isodate_str(request.GET.get("to_date", None))
-    limit = int(request.GET.get("limit", 100))
-    offset = int(request.GET.get("offset", 0))
-    term = request.GET.get("term", None)
-
     if not from_date:
         from_date = datetime.datetime.fromtimestamp(0)
     if not to_date:
         to_date = datetime.datetime.today() + datetime.timedelta(days=1)
+    return from_date, to_date
 
-    modified_from_query = Q(date_modified__gte=from_date)
-    modified_to_query = Q(date_modified__lt=to_date)
-    is_active_query = Q(is_active=True)
 
-    objects = []
-    if term:
+def _data_query(request):
+    """
+        Compiles the filters of a /data request into a query, without is_active, and the index to read it with.
+        Raises ValueError for invalid filters and for filters that no index serves.
+    """
+    from_date, to_date = _modified_dates(request)
+    query = Q(date_modified__gte=from_date) & Q(date_modified__lt=to_date)
+    filters = []
+
+    terms = [term for value in request.GET.getlist("term") for term in value.split(",") if term]
+    if terms:
+        variable_ids = []
+        for term in terms:
+            variable = variable_registry.get(term)
+            if variable:
+                variable_ids.append(variable.id)
+            else:
+                logger.warn(u"Unknown variable {}, skipping..".format(term))
+        query = query & Q(variable__in=variable_ids)
+        filters.append("variable")
+
+    if request.GET.get("sample_year", None):
+        try:
+            query = query & Q(sample_year=int(request.GET["sample_year"]))
+        except ValueError:
+            raise ValueError(u"Invalid sample_year {}".format(request.GET["sample_year"]))
+        filters.append("sample_year")
+
+    for name in ("sigel", "target_group"):
+        if request.GET.get(name, None):
+            query = query & Q(**{name: request.GET[name]})
+            filters.append(name)
+
+    index = OpenData.objects.data_api_index(filters)
+    if index is None:
+        raise ValueError(u"Filtering on {} needs sample_year, sigel or term too".format(u", ".join(filters)))
+    return query, index
+
+
+def _data_validators(request):
+    try:
+        query, index = _data_query(request)
+    except ValueError:
+        return None
+    # Inactive open data is included since unpublishing also changes the response
+    objects = OpenData.objects.filter(query & Q(is_active__in=[True, False])).hint(index)
+    # No Last-Modified, as deleting open data does not move it. The ETag is made from the latest
+    # modification and the generation, which also changes when publishing deletes open data.
+    return None, (last_modified(objects), Generation.current(OpenData.GENERATION))
+
+
+@api_condition(_data_validators)
+def data_api(request):
+    limit = int(request.GET.get("limit", 100))
+    offset = int(request.GET.get("offset", 0))
+    after = request.GET.get("after", None)
+
+    try:
+        query, index = _data_query(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(unicode(e))
+    if after:
         try:
-            variable = Variable.objects.get(key=term)
-            logger.debug(
-                u"Fetching statistics data for term {} published between {} and {}, items {} to {}".format(
-                    variable.key,
-                    from_date,
-                    to_date,
-                    offset,
-                    offset + limit))
-            objects = OpenData.objects.filter(
-                Q(variable=variable)
-                & modified_from_query
-                & modified_to_query
-                & is_active_query).skip(offset).limit(limit)
-        except Exception:
-            logger.warn(u"Unknown variable {}, skipping..".format(term))
+            query = query & after_query(after)
+        except ValueError:
+            return HttpResponseBadRequest()
+        # The position is given by the token
+        offset = 0
+
+    logger.debug(u"Fetching statistics data with {}, items {} to {}".format(
+        dict(request.GET.items()), offset, offset + limit))
+    objects = OpenData.objects.filter(query & Q(is_active=True)).hint(index).order_by(
+        "-date_modified", "-id").skip(offset).limit(limit)
+
+    objects = objects.only(*OpenData.RAW_FIELDS).as_pymongo()
+    next_parameters = [(name, value.encode("utf-8")) for name, values in sorted(request.GET.lists())
+                       if name in DATA_API_FILTERS for value in values] + [("limit", limit)]
+    chunks = _data_chunks(objects, limit, next_parameters)
+
+    if limit > DATA_API_STREAMING_LIMIT:
+        return StreamingHttpResponse(chunks, content_type="application/ld+json")
+    return HttpResponse("".join(chunks), content_type="application/ld+json")
 
+
+def _data_chunks(objects, limit, next_parameters):
+    """
+        Writes the data set with the raw observations as JSON, DATA_API_CHUNK_SIZE observations at a time.
+    """
+    yield json.dumps(data_set)[:-1] + ', "observations": ['
+
+    count = 0
+    last = None
+    chunk = []
+    for open_data in objects:
+        chunk.append(json.dumps(OpenData.raw_to_dict(open_data)))
+        count += 1
+        last = open_data
+        if len(chunk) == DATA_API_CHUNK_SIZE:
+            yield ("," if count > len(chunk) else "") + ",".join(chunk)
+            chunk = []
+    if chunk:
+        yield ("," if count > len(chunk) else "") + ",".join(chunk)
+
+    if count >= limit:
+        next_link = u"?{}".format(urllib.urlencode(
+            next_parameters + [("after", encode_after(last["date_modified"], last["_id"]))]))
+        yield '], "next": {}}}'.format(json.dumps(next_link))
     else:
-        logger.debug(
-            u"Fetching statistics data published between {} and {}, items {} to {}".format(
-                from_date, to_date, offset, offset + limit))
-        objects = OpenData.objects.filter(
-            modified_from_query
-            & modified_to_query
-            & is_active_query).skip(offset).limit(limit)
-
-    observations = []
-    for item in objects:
-        observations.append(item.to_dict())
-
-    data = dict(data_set, observations=observations)
-    if len(observations) >= limit:
-        data[u"next"] = u"?limit={}&offset={}".format(limit, offset + limit)
+        yield "]}"
+
+
+def encode_since(sequence):
+    """
+        Opaque token for the position after a change in /data/changes.
+    """
+    return base64.urlsafe_b64encode(str(sequence))
+
+
+def decode_since(token):
+    """
+        Returns the sequence number encoded by 'encode_since', raises ValueError for invalid tokens.
+    """
+    try:
+        return int(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError(u"Invalid since token {}".format(token))
+
+
+def changes_api(request):
+    limit = int(request.GET.get("limit", 100))
+    since = request.GET.get("since", None)
+    try:
+        sequence = decode_since(since) if since else 0
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    changes = OpenDataChange.changes_since(sequence, limit)
+    upserted_ids = [change["open_data"] for change in changes if change["operation"] == OpenDataChange.UPSERT]
+    upserted = dict((open_data["_id"], open_data) for open_data in OpenData.objects.filter(
+        id__in=upserted_ids, is_active=True).only(*OpenData.RAW_FIELDS).as_pymongo())
+
+    feed = []
+    for change in changes:
+        if change["operation"] == OpenDataChange.DELETE:
+            feed.append({u"@id": str(change["open_data"]), u"change": OpenDataChange.DELETE})
+        elif change["open_data"] in upserted:
+            feed.append({u"@id": str(change["open_data"]), u"change": OpenDataChange.UPSERT,
+                         u"observation": OpenData.raw_to_dict(upserted[change["open_data"]])})
+        # Otherwise the observation has been deactivated or deleted by a later change
 
+    if changes:
+        sequence = changes[-1]["sequence"]
+    data = dict(data_set, changes=feed,
+                next=u"?{}".format(urllib.urlencode([("since", encode_since(sequence)), ("limit", limit)])))
     return HttpResponse(json.dumps(data), content_type="application/ld+json")
 
 
+def _observation_validators(request, observation_id):
+    try:
+        open_data = OpenData._get_collection().find_one({"_id": ObjectId(observation_id)}, {"date_modified": True})
+    except InvalidId:
+        return None
+    return (open_data["date_modified"], observation_id) if open_data else None
+
+
+@api_condition(_observation_validators)
 def observation_api(request, observation_id):
     try:
         open_data = OpenData.objects.get(pk=observation_id)
@@ -108,6 +270,24 @@ def observation_api(request, observation_id):
     return HttpResponse(json.dumps(observation), content_type="application/ld+json")
 
 
+def dump_api(request, year, dump_format):
+    year = int(year)
+    if not has_open_data(year):
+        return HttpResponseNotFound()
+
+    artifact = dump_artifact(year, dump_format)
+    if accepts_gzip(request):
+        # The stored dump is sent as is, with ranges, to clients that accept gzip
+        response = artifact_response(request, artifact, DUMP_FORMATS[dump_format])
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = StreamingHttpResponse(FileWrapper(gzip.GzipFile(fileobj=open_artifact(artifact), mode="rb")),
+                                         content_type=DUMP_FORMATS[dump_format])
+    response["Vary"] = "Accept-Encoding"
+    response["Content-Disposition"] = u'attachment; filename="biblioteksstatistik_{}.{}"'.format(year, dump_format)
+    return response
+
+
 def export_api(request):
     if request.method == "GET":
 
@@ -125,8 +305,8 @@ def export_api(request):
             return HttpResponseNotFound()
 
         filename = u"Biblioteksstatistik för {} ({}).xlsx".format(sample_year, strftime("%Y-%m-%d %H.%M.%S"))
-        path = public_excel_workbook(sample_year)
+        artifact = public_export_artifact(sample_year)
 
-        response = HttpResponse(FileWrapper(file(path)), content_type='application/vnd.ms-excel')
+        response = artifact_response(request, artifact, 'application/vnd.ms-excel')
         response['Content-Disposition'] = u'attachment; filename="{}"'.format(filename)
         return response
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import json
+import threading
+
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, Http404
 from bibstat import settings
-from libstat.models import Variable
+from libstat.apis.conditional import api_condition
+from libstat.models import variable_registry
 
 
 term_context = {
@@ -84,27 +87,85 @@ core_terms = [
 core_term_ids = {term[u"@id"] for term in core_terms}
 
 
+def _public_terms():
+    return [variable for variable in variable_registry.all() if variable.is_public and not variable.is_draft]
+
+
+class TermDocuments(object):
+    """
+        The /def/terms vocabulary and the /def/terms/<key> documents, serialized once from the variable registry.
+        They are rebuilt when the registry is reloaded, which the save and delete signals of Variable cause in
+        every process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built = (None, None)
+
+    def vocabulary(self):
+        return self._current()[0]
+
+    def term(self, key):
+        """
+            The serialized document of a public term, or None.
+        """
+        return self._current()[1].get(key)
+
+    def _current(self):
+        version = variable_registry.version
+        built_version, documents = self._built
+        if documents is not None and built_version == version:
+            return documents
+
+        with self._lock:
+            built_version, documents = self._built
+            if documents is None or built_version != version:
+                documents = self._build()
+                self._built = (version, documents)
+            return documents
+
+    def _build(self):
+        terms = core_terms[:]
+        term_documents = {}
+        for variable in _public_terms():
+            term = variable.to_dict()
+            terms.append(term)
+            data = {u"@context": term_context}
+            data.update(term)
+            data["isDefinedBy"] = terms_vocab["@id"]
+            term_documents[variable.key] = json.dumps(data)
+        return json.dumps(dict(terms_vocab, terms=terms)), term_documents
+
+
+term_documents = TermDocuments()
+
+
+def _term_validators(request, term_key):
+    variable = variable_registry.get(term_key)
+    if not variable or not variable.is_public or variable.is_draft:
+        return None
+    # Replacing or replaced variables are changed without changing this one
+    return variable.date_modified, variable_registry.generation
+
+
+def _terms_validators(request):
+    dates = [variable.date_modified for variable in _public_terms() if variable.date_modified]
+    return (max(dates) if dates else None), variable_registry.generation
+
+
+@api_condition(_term_validators)
 def term_api(request, term_key):
-    try:
-        term = Variable.objects.public_term_by_key(term_key)
-    except Exception:
+    document = term_documents.term(term_key)
+    if document is None:
         if term_key in core_term_ids:
             http303 = HttpResponse(content="", status=303)
             http303["Location"] = reverse("terms_api")
             return http303
         else:
             raise Http404
-    data = {u"@context": term_context}
-    data.update(term.to_dict())
-    data["isDefinedBy"] = terms_vocab["@id"]
-    return HttpResponse(json.dumps(data), content_type="application/ld+json")
+    return HttpResponse(document, content_type="application/ld+json")
 
 
+@api_condition(_terms_validators)
 def terms_api(request):
-    terms = core_terms[:]
-
-    variables = Variable.objects.public_terms()
-    for v in variables:
-        terms.append(v.to_dict())
-    data = dict(terms_vocab, terms=terms)
-    return HttpResponse(json.dumps(data), content_type="application/ld+json")
\ No newline at end of file
+    return HttpResponse(term_documents.vocabulary(), content_type="application/ld+json")
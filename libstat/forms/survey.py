@@ -9,7 +9,7 @@ from django.core.urlresolvers import reverse
 
 from bibstat import settings
 from data.municipalities import municipalities
-from libstat.models import Survey, Variable, SurveyObservation
+from libstat.models import Survey, SurveyObservation, CoReportingGraph, variable_registry
 from libstat.survey_templates import survey_template
 
 logger = logging.getLogger(__name__)
@@ -115,8 +115,8 @@ class SurveyForm(forms.Form):
 
         return field
 
-    def _set_libraries(self, current_survey, this_surveys_selected_sigels, authenticated):
-        other_surveys_selected_sigels = current_survey.selected_sigels_in_other_surveys(self.sample_year)
+    def _set_libraries(self, current_survey, this_surveys_selected_sigels, authenticated, co_reporting):
+        other_surveys_selected_sigels = current_survey.selected_sigels_in_other_surveys(self.sample_year, co_reporting)
 
         def set_library(self, library, current_library=False):
 
@@ -208,9 +208,8 @@ class SurveyForm(forms.Form):
         authenticated = kwargs.pop('authenticated', False)
         super(SurveyForm, self).__init__(*args, **kwargs)
 
-        # Cache variables for performance
         variables = {}
-        for variable in Variable.objects.all():
+        for variable in variable_registry.all():
             variables[variable.key] = variable
 
         template = survey_template(survey.sample_year, survey)
@@ -255,10 +254,11 @@ class SurveyForm(forms.Form):
         self.email = survey.library.email
         self.mailto = self._mailto_link()
 
-        self._set_libraries(survey, survey.selected_libraries, authenticated)
+        co_reporting = CoReportingGraph(survey.sample_year)
+        self._set_libraries(survey, survey.selected_libraries, authenticated, co_reporting)
 
         if hasattr(self, 'library_selection_conflict') and self.library_selection_conflict:
-            self.conflicting_surveys = survey.get_conflicting_surveys()
+            self.conflicting_surveys = survey.get_conflicting_surveys(co_reporting)
             for conflicting_survey in self.conflicting_surveys:
                 conflicting_survey.url = settings.API_BASE_URL + reverse('survey', args=(conflicting_survey.pk,))
                 conflicting_survey.conflicting_libraries = self._conflicting_libraries(
@@ -267,7 +267,8 @@ class SurveyForm(forms.Form):
 
             self.can_submit = False
 
-        previous_survey = survey.previous_years_survey()
+        previous_survey_ids = Survey.previous_years_survey_ids([survey])[0]
+        previous_survey = Survey.objects.filter(pk=previous_survey_ids[0]).first() if previous_survey_ids else None
 
         for cell in template.cells:
             variable_key = cell.variable_key
@@ -281,7 +282,7 @@ class SurveyForm(forms.Form):
                 cell.disabled = observation.disabled #TODO: remove?
                 cell.value_unknown = observation.value_unknown
                 if previous_survey:
-                    cell.previous_value = survey.previous_years_value(observation.variable, previous_survey)
+                    cell.previous_value = survey.previous_years_value(variables[variable_key], previous_survey)
             if not observation:
                 observation = SurveyObservation(variable=variables[variable_key])
                 survey.observations.append(observation)
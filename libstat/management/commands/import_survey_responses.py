@@ -10,7 +10,7 @@ from xlrd.biffh import XLRDError
 from data.municipalities import municipality_code_from, municipality_code_from_county_code
 
 from libstat.utils import TYPE_BOOLEAN, TYPE_INTEGER, TYPE_LONG
-from libstat.models import Survey, SurveyObservation, Variable, Library
+from libstat.models import Survey, SurveyObservation, Library, variable_registry
 
 
 logger = logging.getLogger(__name__)
@@ -53,9 +53,8 @@ class Command(BaseCommand):
 
         for i in range(0, work_sheet.ncols):
             key = work_sheet.cell_value(0, i)
-            variables = Variable.objects.filter(key=key)
-            if len(variables) > 0:
-                variable = variables[0]
+            variable = variable_registry.get(key)
+            if variable:
                 if variable.sub_category in [u"Biblioteksnamn"]:
                     library_name_column = i
                 variable_keys.append((i, variable))
@@ -0,0 +1,17 @@
+# -*- coding: UTF-8 -*-
+import logging
+
+from django.core.management.base import BaseCommand
+
+from libstat.services.data_migrations import migrate
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs the data migrations not yet run on the database, run after each deploy"
+
+    def handle(self, *args, **options):
+        num_migrations = migrate()
+        logger.info(u"...{} data migrations run".format(num_migrations))
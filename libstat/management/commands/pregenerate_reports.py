@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from libstat.services.excel_export import regenerate_public_export
+from libstat.services.open_data_dump import write_dumps
+from libstat.services.report_pregeneration import pregenerate_reports, published_years_changed_since
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Generates and caches the reports of each municipality, county and principal and of the whole country, "
+            "either once for a sample year or, with --watch, after every batch of publishing, when the open data "
+            "dumps and public exports of the published years are also rewritten")
+    help_text = ("Usage: python manage.py pregenerate_reports --year=<YYYY> [--processes=<N>]\n"
+                 "       python manage.py pregenerate_reports --watch [--processes=<N>] [--interval=<seconds>] "
+                 "[--quiet_period=<seconds>]\n\n")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--year', dest="year", type='int',
+                    help='Year; Sample year to generate reports for, format YYYY'),
+        make_option('--processes', dest="processes", type='int', default=1,
+                    help='Processes; Number of worker processes generating reports'),
+        make_option('--watch', dest="watch", action='store_true', default=False,
+                    help='Watch; Keep running and regenerate the reports of each sample year published to'),
+        make_option('--interval', dest="interval", type='int', default=10,
+                    help='Interval; Seconds between checks for published surveys in watch mode'),
+        make_option('--quiet_period', dest="quiet_period", type='int', default=60,
+                    help='Quiet period; Seconds without publishing before reports are regenerated in watch mode'),
+    )
+
+    def _progress(self, done, total, selection, number_of_surveys, seconds):
+        area, principal = selection
+        logger.info(u"{}/{} {} {}: {} surveys in {:.2f}s".format(done, total, area or u"riket", principal or u"",
+                                                                  number_of_surveys, seconds))
+
+    def _pregenerate(self, year, processes):
+        started = time.time()
+        logger.info(u"Generating reports for {}...".format(year))
+        num_reports = pregenerate_reports(year, processes=processes, progress=self._progress)
+        logger.info(u"...{} reports for {} generated in {:.1f}s".format(num_reports, year, time.time() - started))
+
+    def _watch(self, processes, interval, quiet_period):
+        generations = {}
+        published_years_changed_since(generations)
+        pending = set()
+        pending_dumps = set()
+        last_change = None
+        while True:
+            changed = published_years_changed_since(generations)
+            if changed:
+                # Reports of the two following years show the changed year as a previous year
+                pending.update(y for year in changed for y in (year, year + 1, year + 2))
+                pending_dumps.update(changed)
+                last_change = time.time()
+            elif pending and time.time() - last_change >= quiet_period:
+                for year in sorted(pending_dumps, reverse=True):
+                    write_dumps(year)
+                    regenerate_public_export(year)
+                for year in sorted(pending, reverse=True):
+                    self._pregenerate(year, processes)
+                pending.clear()
+                pending_dumps.clear()
+            time.sleep(interval)
+
+    def handle(self, *args, **options):
+        year = options.get(u"year")
+        processes = options.get(u"processes")
+
+        if processes < 1:
+            raise CommandError(u"Invalid number of processes '{}', aborting".format(processes))
+
+        if options.get(u"watch"):
+            self._watch(processes, options.get(u"interval"), options.get(u"quiet_period"))
+        elif year:
+            self._pregenerate(year, processes)
+        else:
+            logger.info(self.help_text)
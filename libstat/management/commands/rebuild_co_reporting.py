@@ -0,0 +1,28 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+import logging
+
+from django.core.management.base import BaseCommand
+
+from libstat.models import Survey
+from libstat.services.data_migrations import store_co_reporting
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Recomputes the stored co-reporting fields of all surveys, e.g. after importing surveys"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--year', dest="year", type='int',
+                    help='Year; Only recompute the surveys of this sample year, format YYYY'),
+    )
+
+    def handle(self, *args, **options):
+        year = options.get(u"year")
+        if year:
+            changed = Survey.update_co_reporting(year)
+            logger.info(u"...co-reporting of {} surveys for {} updated".format(len(changed), year))
+        else:
+            store_co_reporting()
@@ -0,0 +1,24 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+import logging
+
+from django.core.management.base import BaseCommand
+
+from libstat.models import NationalTotal
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the national totals per variable and sample year from published open data"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--year', dest="year", type='int',
+                    help='Year; Only rebuild totals for this sample year, format YYYY'),
+    )
+
+    def handle(self, *args, **options):
+        year = options.get(u"year")
+        num_totals = NationalTotal.rebuild(sample_year=year)
+        logger.info(u"...{} national totals rebuilt".format(num_totals))
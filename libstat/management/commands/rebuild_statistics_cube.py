@@ -0,0 +1,24 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+import logging
+
+from django.core.management.base import BaseCommand
+
+from libstat.models import StatisticsCell
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the statistics cube from published surveys and their open data"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--year', dest="year", type='int',
+                    help='Year; Only rebuild cells for this sample year, format YYYY'),
+    )
+
+    def handle(self, *args, **options):
+        year = options.get(u"year")
+        num_partitions = StatisticsCell.rebuild(sample_year=year)
+        logger.info(u"...{} statistics cube partitions rebuilt".format(num_partitions))
@@ -3,16 +3,24 @@ import logging
 from sets import Set
 import string
 import random
+import re
+import threading
+import time
 
 from mongoengine import *
 from mongoengine import signals
 from django.conf import settings
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from mongoengine.context_managers import no_dereference
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from data.municipalities import MUNICIPALITIES
 from data.principals import get_library_types_with_same_principal, principal_for_library_type
+from libstat.query_sets.aggregation import aggregate
 from libstat.query_sets.variable import VariableQuerySet
+from libstat.query_sets.open_data import OpenDataQuerySet
+from libstat.query_sets.statistics_cube import StatisticsCellQuerySet
 
 from libstat.utils import ISO8601_utc_format
 from libstat.utils import SURVEY_TARGET_GROUPS, targetGroups, VARIABLE_TYPES, rdfVariableTypes
@@ -110,8 +118,15 @@ class Variable(VariableBase):
 
         document.date_modified = datetime.utcnow()
 
+    @classmethod
+    def post_save_actions(cls, sender, document, **kwargs):
+        variable_registry.invalidate()
+        Generation.bump(VariableRegistry.GENERATION)
+
     @classmethod
     def post_delete_actions(cls, sender, document, **kwargs):
+        variable_registry.invalidate()
+        Generation.bump(VariableRegistry.GENERATION)
         if document.replaces:
             for replaced in document.replaces:
                 if replaced.replaced_by and replaced.replaced_by.id == document.id:
@@ -265,6 +280,116 @@ class VariableVersion(VariableBase):
     }
 
 
+class Generation(Document):
+    """
+        Shared counter used to tell all worker processes that cached data derived from a
+        collection has gone stale. Also used for plain statistics counters.
+    """
+    name = StringField(required=True, unique=True)
+    value = IntField(required=True, default=0)
+
+    meta = {
+        'collection': 'libstat_generations',
+    }
+
+    @classmethod
+    def current(cls, name):
+        generation = cls._get_collection().find_one({"name": name}, {"value": True})
+        return generation["value"] if generation else 0
+
+    @classmethod
+    def bump(cls, name, amount=1):
+        cls.objects(name=name).update_one(inc__value=amount, upsert=True)
+
+    @classmethod
+    def reserve(cls, name, amount):
+        """
+            Bumps the counter and returns the 'amount' values reserved by the bump, in increasing order.
+        """
+        generation = cls._get_collection().find_and_modify({"name": name}, {"$inc": {"value": amount}},
+                                                           upsert=True, new=True)
+        return range(generation["value"] - amount + 1, generation["value"] + 1)
+
+
+def _reference_id(reference):
+    # Raw references are DBRefs, ObjectIds or already dereferenced documents
+    return getattr(reference, "id", reference)
+
+
+class VariableRegistry(object):
+    """
+        Read-mostly, process wide cache of all variables by key and by id, where the 'replaces'
+        and 'replaced_by' references point at the registry's own instances. It is reloaded when
+        a variable is saved or deleted in this process, or when the shared 'variables' generation
+        shows that another process has done so (checked at most every CHECK_INTERVAL seconds).
+
+        The variables are shared between requests and must not be modified or saved.
+    """
+    GENERATION = u"variables"
+    CHECK_INTERVAL = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._variables = None
+        self._generation = None
+        self._checked_at = 0
+        self._loads = 0
+
+    def invalidate(self):
+        self._variables = None
+
+    @property
+    def generation(self):
+        self._current()
+        return self._generation
+
+    @property
+    def version(self):
+        """
+            Changes each time the variables are reloaded, also after 'invalidate' in this process.
+        """
+        self._current()
+        return self._loads
+
+    def get(self, key):
+        return self._current()[0].get(key)
+
+    def get_by_id(self, variable_id):
+        if isinstance(variable_id, basestring):
+            variable_id = ObjectId(variable_id)
+        return self._current()[1].get(variable_id)
+
+    def all(self):
+        return sorted(self._current()[0].values(), key=lambda variable: variable.key)
+
+    def _current(self):
+        variables = self._variables
+        if variables is not None and time.time() - self._checked_at < self.CHECK_INTERVAL:
+            return variables
+
+        with self._lock:
+            generation = Generation.current(self.GENERATION)
+            if self._variables is None or generation != self._generation:
+                self._variables = self._load()
+                self._generation = generation
+                self._loads += 1
+            self._checked_at = time.time()
+            return self._variables
+
+    def _load(self):
+        variables = list(Variable.objects.all())
+        by_id = dict((variable.id, variable) for variable in variables)
+        for variable in variables:
+            replaces = [_reference_id(replaced) for replaced in variable._data.get("replaces") or []]
+            variable._data["replaces"] = [by_id[replaced] for replaced in replaces if replaced in by_id]
+            replaced_by = _reference_id(variable._data.get("replaced_by"))
+            variable._data["replaced_by"] = by_id.get(replaced_by) if replaced_by else None
+        return dict((variable.key, variable) for variable in variables), by_id
+
+
+variable_registry = VariableRegistry()
+
+
 class ExternalIdentifier(EmbeddedDocument):
     ID_TYPES = (
         (u"school_code", u"Skolenhetskod")
@@ -318,6 +443,11 @@ class SurveyObservation(EmbeddedDocument):
     def __unicode__(self):
         return u"{0}: {1}".format(self.variable, self.value)
 
+    @property
+    def variable_id(self):
+        # Reads the reference without dereferencing it
+        return _reference_id(self._data.get("variable"))
+
     @property
     def instance_id(self):
         return self._instance.id
@@ -362,16 +492,37 @@ class SurveyQuerySet(QuerySet):
             sigel_query = Q(library__sigel__iexact=sigel)
             order_by_field = "library__sigel"
 
+        # Leaves out surveys without selected libraries whose library is reported in another survey
+        not_co_reported_by_other_query = (Q(_is_reported_by_other__ne=True) | Q(selected_libraries__not__size=0)
+                                          if exclude_co_reported_by_other else Q())
+
         filtered_result = self.filter(target_group_query & sample_year_query & status_query &
                                       municipality_code_query & email_query & free_text_query &
-                                      is_active_query & sigel_query).exclude("observations").order_by(order_by_field)
-
-        if exclude_co_reported_by_other:
-            co_reported_by_others = filtered_result.filter(selected_libraries__size=0, library__sigel__in=Survey.objects.filter(sample_year=sample_year).distinct("selected_libraries")).exclude("observations")
-            filtered_result = set(filtered_result).difference(set(co_reported_by_others))
+                                      is_active_query & sigel_query & not_co_reported_by_other_query
+                                      ).exclude("observations").order_by(order_by_field)
 
         return filtered_result
 
+    def counts_by_library_type_and_status(self):
+        """
+            Counts the surveys of this query set per library type and status. Returns a dict
+            {(library_type, status): (count, count without the surveys co-reported by another survey)}.
+        """
+        co_reported_by_other = {"$and": ["$_is_reported_by_other", {"$eq": ["$selected_libraries", []]}]}
+        pipeline = [
+            {"$match": self._query},
+            {"$group": {
+                "_id": {"library_type": "$library.library_type", "status": "$_status"},
+                "count": {"$sum": 1},
+                "co_reported_by_other": {"$sum": {"$cond": [co_reported_by_other, 1, 0]}}
+            }}
+        ]
+        counts = {}
+        for row in aggregate(self, pipeline):
+            key = (row["_id"].get("library_type"), row["_id"].get("status"))
+            counts[key] = (row["count"], row["count"] - row["co_reported_by_other"])
+        return counts
+
 
 class SurveyBase(Document):
     PRINCIPALS = (
@@ -407,6 +558,12 @@ class SurveyBase(Document):
     _municipality_code = StringField()
     _library_type = StringField()
 
+    # Co-reporting within the sample year, stored for filtering and kept up to date when surveys are saved
+    _reported_by = ListField(StringField())
+    _is_reported_by_other = BooleanField(default=False)
+    _is_reporting_for_others = BooleanField(default=False)
+    _has_conflict = BooleanField(default=False)
+
     meta = {
         'abstract': True,
     }
@@ -438,13 +595,12 @@ class SurveyBase(Document):
 
     def get_observation(self, key, variable=None, variable_id=None, backtrack_replaced_variables=False):
         if variable is None:
-            variables = Variable.objects.filter(id=variable_id) if variable_id else Variable.objects.filter(key=key)
-            if len(variables) == 0:
+            variable = variable_registry.get_by_id(variable_id) if variable_id else variable_registry.get(key)
+            if variable is None:
                 return None
-            variable = variables[0]
 
         for observation in self.observations:
-            if observation.variable == variable:
+            if observation.variable_id == variable.id:
                 return observation
 
         if backtrack_replaced_variables and len(variable.replaces) == 1:
@@ -492,83 +648,34 @@ class SurveyBase(Document):
 
         return selectable_libs
 
-    #TODO: optimize by caching surveys by samle_year and municipality_code?
-
-    def selected_sigels_in_other_surveys(self, sample_year):
-        if not self.library.municipality_code:
-            return Set()
-
-        surveys = Survey.objects.filter(
-            sample_year=sample_year,
-            library__municipality_code=self.library.municipality_code,
-            library__library_type__in=get_library_types_with_same_principal(self.library),
-            library__sigel__ne=self.library.sigel
-        ).only("selected_libraries")
-
-        selected_sigels = Set()
-        for survey in surveys:
-            for sigel in survey.selected_libraries:
-                selected_sigels.add(sigel)
-
-        return selected_sigels
-
-    def has_conflicts(self):
-        for selected_sigel in self.selected_sigels_in_other_surveys(self.sample_year):
-            if selected_sigel in self.selected_libraries or selected_sigel == self.library.sigel:
-                return True
-
-        return False
-
-    #TODO: optimize by caching surveys by samle_year and municipality_code?
-
-    def get_conflicting_surveys(self):
-        if not self.library.municipality_code:
-            return []
-
-        other_surveys = Survey.objects.filter(
-            sample_year=self.sample_year,
-            library__municipality_code=self.library.municipality_code,
-            library__library_type__in=get_library_types_with_same_principal(self.library),
-            library__sigel__ne=self.library.sigel
-        )
-
-        return [
-            other_survey for other_survey in other_surveys
-            if any(sigel in other_survey.selected_libraries for sigel in self.selected_libraries)
-            or self.library.sigel in other_survey.selected_libraries
-        ]
-
-    def get_conflicting_surveys_return_only_libs_and_selected_libs(self):
-        if not self.library.municipality_code:
-            return []
+    def _co_reporting(self, co_reporting):
+        if co_reporting is not None and co_reporting.sample_year == self.sample_year:
+            return co_reporting
+        return CoReportingGraph(self.sample_year)
 
-        other_surveys = Survey.objects.filter(
-            sample_year=self.sample_year,
-            library__municipality_code=self.library.municipality_code,
-            library__library_type__in=get_library_types_with_same_principal(self.library),
-            library__sigel__ne=self.library.sigel
-        ).only("library", "selected_libraries")
+    def selected_sigels_in_other_surveys(self, sample_year, co_reporting=None):
+        if co_reporting is None or co_reporting.sample_year != sample_year:
+            co_reporting = CoReportingGraph(sample_year)
+        return co_reporting.selected_sigels_in_other_surveys(self)
 
-        return [
-            other_survey for other_survey in other_surveys
-            if any(sigel in other_survey.selected_libraries for sigel in self.selected_libraries)
-            or self.library.sigel in other_survey.selected_libraries
-        ]
+    def has_conflicts(self, co_reporting=None):
+        return self._co_reporting(co_reporting).has_conflicts(self)
 
-    #TODO: optimize by saving reported_by, is_reported_by_other and is_reporting_for_others to db?
+    def get_conflicting_surveys(self, co_reporting=None):
+        ids = self._co_reporting(co_reporting).conflicting_survey_ids(self)
+        surveys = Survey.objects.in_bulk(ids) if ids else {}
+        return [surveys[pk] for pk in ids if pk in surveys]
 
-    def reported_by(self):
-        surveys = Survey.objects.filter(sample_year=self.sample_year, selected_libraries__contains=self.library.sigel).only("library", "selected_libraries")
+    def get_conflicting_surveys_return_only_libs_and_selected_libs(self, co_reporting=None):
+        ids = self._co_reporting(co_reporting).conflicting_survey_ids(self)
+        surveys = Survey.objects.only("library", "selected_libraries").in_bulk(ids) if ids else {}
+        return [surveys[pk] for pk in ids if pk in surveys]
 
-        result = [survey.library.sigel for survey in surveys if self.library.sigel in survey.selected_libraries]
-        return result
+    def reported_by(self, co_reporting=None):
+        return self._co_reporting(co_reporting).reported_by(self)
 
-    def is_reported_by_other(self):
-        other_surveys_selected_sigels = Survey.objects.filter(sample_year=self.sample_year, pk__ne=self.pk, selected_libraries__contains=self.library.sigel).count()
-        if other_surveys_selected_sigels > 0:
-            return True
-        else:
-            return False
+    def is_reported_by_other(self, co_reporting=None):
+        return self._co_reporting(co_reporting).is_reported_by_other(self)
 
     def is_reporting_for_others(self):
         return any(sigel != self.library.sigel for sigel in self.selected_libraries)
@@ -585,7 +692,12 @@ class Survey(SurveyBase):
             "library.name",
             "sample_year",
             "_status",
-            "is_active"
+            "is_active",
+            # Libraries of a year in sigel order, for the public Excel export
+            ("sample_year", "library.sigel"),
+            # Co-reporting, see CoReportingGraph
+            ("sample_year", "selected_libraries"),
+            ("sample_year", "_is_reported_by_other")
         ]
     }
 
@@ -598,6 +710,78 @@ class Survey(SurveyBase):
                                                      library__name__iexact=self.library.name).first()
         return previous_survey
 
+    @classmethod
+    def previous_years_survey_ids(cls, surveys, years=1):
+        """
+            Bulk version of 'previous_years_survey'. Follows each survey's published predecessors
+            (matched by sigel, or by library name ignoring case) up to 'years' years back, using at
+            most two queries per year. Returns one list of predecessor ids per survey, in the order
+            the surveys were given, most recent year first and ending where the lineage breaks.
+        """
+        return [[previous.pk for previous in lineage] for lineage in cls.previous_years_surveys(surveys, years)]
+
+    @classmethod
+    def previous_years_surveys(cls, surveys, years=1):
+        """
+            Same as 'previous_years_survey_ids', but returns the predecessors with only 'sample_year',
+            'library.sigel' and 'library.name' loaded.
+        """
+        lineages = [[] for survey in surveys]
+        libraries = dict((index, (survey.sample_year, survey.library.sigel, survey.library.name))
+                         for index, survey in enumerate(surveys) if survey.sample_year and survey.library)
+
+        for _ in range(years):
+            if not libraries:
+                break
+
+            published = Survey.objects.filter(
+                _status=u"published",
+                sample_year__in=list(set(year - 1 for year, sigel, name in libraries.values()))
+            ).only("sample_year", "library.sigel", "library.name")
+
+            previous_by_sigel = {}
+            sigels = list(set(sigel for year, sigel, name in libraries.values() if sigel))
+            for previous in published.filter(library__sigel__in=sigels):
+                previous_by_sigel.setdefault((previous.sample_year, previous.library.sigel), previous)
+
+            found = {}
+            for index, (year, sigel, name) in libraries.iteritems():
+                if (year - 1, sigel) in previous_by_sigel:
+                    found[index] = previous_by_sigel[(year - 1, sigel)]
+
+            names = list(set(name for index, (year, sigel, name) in libraries.iteritems()
+                             if index not in found and name))
+            if names:
+                name_patterns = [re.compile(u"^{}$".format(re.escape(name)), re.IGNORECASE) for name in names]
+                previous_by_name = {}
+                for previous in published.filter(__raw__={"library.name": {"$in": name_patterns}}):
+                    previous_by_name.setdefault((previous.sample_year, previous.library.name.lower()), previous)
+                for index, (year, sigel, name) in libraries.iteritems():
+                    if index not in found and name and (year - 1, name.lower()) in previous_by_name:
+                        found[index] = previous_by_name[(year - 1, name.lower())]
+
+            libraries = {}
+            for index, previous in found.iteritems():
+                lineages[index].append(previous)
+                libraries[index] = (previous.sample_year, previous.library.sigel, previous.library.name)
+
+        return lineages
+
+    @classmethod
+    def library_keys(cls, sample_year, sigel, name):
+        """
+            Keys for the lookups 'previous_years_survey' makes for a library's survey in a sample year.
+        """
+        keys = [u"{}:sigel:{}".format(sample_year, sigel)]
+        if name:
+            keys.append(u"{}:name:{}".format(sample_year, name.lower()))
+        return keys
+
+    def report_dependency_keys(self):
+        return ([unicode(self.pk)] + Survey.library_keys(self.sample_year, self.library.sigel, self.library.name) +
+                StatisticsCell.selection_keys(self.sample_year, self.library.municipality_code,
+                                              self.library.library_type))
+
     def previous_years_value(self, variable, previous_years_survey=None):
         # allow passing previous survey to reduce db lookups
         if not previous_years_survey:
@@ -606,7 +790,7 @@ class Survey(SurveyBase):
                 return None
 
         for observation in previous_years_survey.observations:
-            if variable == observation.variable:
+            if observation.variable_id == variable.id:
                 return observation.value
 
         replaces = variable.replaces
@@ -619,7 +803,7 @@ class Survey(SurveyBase):
 
         previous_variable = replaces[0]
         for observation in previous_years_survey.observations:
-            if previous_variable == observation.variable:
+            if observation.variable_id == previous_variable.id:
                 return observation.value
 
         return None
@@ -635,8 +819,74 @@ class Survey(SurveyBase):
 
         return True
 
+    def _co_reporting_state(self):
+        library = self.library or Library()
+        return (self.sample_year, library.sigel, library.municipality_code, library.library_type,
+                sorted(self.selected_libraries))
+
+    @classmethod
+    def _stored_co_reporting_state(cls, survey_id):
+        projection = dict((field, 1) for field in CoReportingGraph.FIELDS + ("sample_year",))
+        stored = cls._get_collection().find_one({"_id": survey_id}, projection)
+        if not stored:
+            return None
+        library = stored.get("library") or {}
+        return (stored.get("sample_year"), library.get("sigel"), library.get("municipality_code"),
+                library.get("library_type"), sorted(stored.get("selected_libraries") or []))
+
+    _CO_REPORTING_LOADED = ("sample_year", "library", "selected_libraries", "_reported_by", "_is_reported_by_other",
+                            "_is_reporting_for_others", "_has_conflict")
+
+    @classmethod
+    def update_co_reporting(cls, sample_year, sigels=None, municipality_codes=None):
+        """
+            Stores the co-reporting fields of the surveys of a sample year whose library has one of 'sigels' or
+            is in one of 'municipality_codes', or of all surveys of the year when neither is given. Returns the
+            fields of the surveys that changed as a dict {survey id: fields}.
+        """
+        surveys = Survey.objects.filter(sample_year=sample_year)
+        if sigels is None and municipality_codes is None:
+            surveys = list(surveys.only(*cls._CO_REPORTING_LOADED))
+            co_reporting = CoReportingGraph(sample_year)
+        else:
+            surveys = list(surveys.filter(Q(library__sigel__in=list(sigels or [])) |
+                                          Q(library__municipality_code__in=list(municipality_codes or [])))
+                           .only(*cls._CO_REPORTING_LOADED))
+            # Enough of the year for the reporters and the municipalities of these surveys
+            co_reporting = CoReportingGraph(sample_year,
+                                            sigels=set(survey.library.sigel for survey in surveys),
+                                            municipality_codes=set(survey.library.municipality_code
+                                                                   for survey in surveys))
+
+        changed = {}
+        for survey in surveys:
+            flags = co_reporting.flags(survey)
+            if any(getattr(survey, field) != value for field, value in flags.iteritems()):
+                cls._get_collection().update({"_id": survey.pk}, {"$set": flags})
+                changed[survey.pk] = flags
+        return changed
+
+    @classmethod
+    def _update_co_reporting_of(cls, states):
+        """
+            Updates the surveys whose co-reporting depends on a survey with the given states, (sample year,
+            sigel, municipality code, library type, selected libraries), from before and after a change.
+        """
+        affected = {}
+        for sample_year, sigel, municipality_code, library_type, selected_libraries in filter(None, states):
+            sigels, municipality_codes = affected.setdefault(sample_year, (set(), set()))
+            sigels.update([sigel] + selected_libraries)
+            municipality_codes.add(municipality_code)
+
+        changed = {}
+        for sample_year, (sigels, municipality_codes) in affected.iteritems():
+            changed.update(cls.update_co_reporting(sample_year, sigels, municipality_codes))
+        return changed
+
     @classmethod
     def pre_save(cls, sender, document, **kwargs):
+        document._co_reporting_before = cls._stored_co_reporting_state(document.id) if document.id else None
+
         def store_version_of(document):
             survey = Survey.objects.filter(pk=document.id)
             if survey:
@@ -667,7 +917,21 @@ class Survey(SurveyBase):
         else:
             document.date_modified = document.date_created
 
-    def can_publish(self):
+    @classmethod
+    def post_save(cls, sender, document, **kwargs):
+        before = getattr(document, "_co_reporting_before", None)
+        after = document._co_reporting_state()
+        if before != after:
+            changed = cls._update_co_reporting_of([before, after])
+            if document.pk in changed:
+                # The co-reporting fields were written to the database after the save
+                document.reload()
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        cls._update_co_reporting_of([document._co_reporting_state()])
+
+    def can_publish(self, co_reporting=None):
         if not self.library.municipality_code:
             return False
 
@@ -677,12 +941,12 @@ class Survey(SurveyBase):
         if not self.selected_libraries:
             return False
 
-        if self.has_conflicts():
+        if self.has_conflicts(co_reporting):
             return False
 
         return True
 
-    def reasons_for_not_able_to_publish(self):
+    def reasons_for_not_able_to_publish(self, co_reporting=None):
         reasons = []
         if not self.library.municipality_code:
             reasons.append("Kommunkod saknas")
@@ -693,13 +957,19 @@ class Survey(SurveyBase):
         if not self.selected_libraries:
             reasons.append("Inga bibliotek har valts")
 
-        if self.has_conflicts():
-            conflicting_surveys = ", ".join([survey.library.sigel for survey in self.get_conflicting_surveys_return_only_libs_and_selected_libs()])
+        co_reporting = self._co_reporting(co_reporting)
+        if self.has_conflicts(co_reporting):
+            conflicting_surveys = ", ".join([survey.library.sigel for survey in self.get_conflicting_surveys_return_only_libs_and_selected_libs(co_reporting)])
             reasons.append("Konflikt i rapporteringen (med {})".format(conflicting_surveys))
 
         return ", ".join(reasons)
 
-    def publish(self):
+    def publish(self, co_reporting=None):
+        # Includes variables whose open data the update below deletes
+        variable_ids = self._open_data_variable_ids() + [observation.variable_id for observation in self.observations]
+
+        changes = []
+
         def update_existing_open_data(self, publishing_date):
             for observation in self.observations:
                 open_datas = OpenData.objects.filter(source_survey=self.pk, variable=observation.variable)
@@ -709,15 +979,20 @@ class Survey(SurveyBase):
                             if open_data.is_active:
                                 open_data.date_modified = publishing_date
                                 open_data.is_active = False
+                                changes.append((open_data.id, OpenDataChange.DELETE))
                         elif observation.value != open_data.value:
                             if observation.value is None or observation.value == "" or observation.value == "-":
                                 open_data.delete()
+                                changes.append((open_data.id, OpenDataChange.DELETE))
                                 continue
                             else:
                                 open_data.value = observation.value
                                 open_data.date_modified = publishing_date
                                 open_data.is_active = True
+                                changes.append((open_data.id, OpenDataChange.UPSERT))
                         else:
+                            if not open_data.is_active:
+                                changes.append((open_data.id, OpenDataChange.UPSERT))
                             open_data.is_active = True
                         open_data.save()
 
@@ -746,11 +1021,12 @@ class Survey(SurveyBase):
                                  date_created=publishing_date,
                                  date_modified=publishing_date,
                         ))
-                OpenData.objects.insert(open_datas, load_bulk=False)
+                open_data_ids = OpenData.objects.insert(open_datas, load_bulk=False)
+                changes.extend((open_data_id, OpenDataChange.UPSERT) for open_data_id in open_data_ids)
 
         publishing_date = datetime.utcnow()
 
-        if not self.can_publish():
+        if not self.can_publish(co_reporting):
             return False
 
         update_existing_open_data(self, publishing_date)
@@ -762,14 +1038,36 @@ class Survey(SurveyBase):
         self._action_publish = True
         self.save()
 
+        OpenDataChange.record(changes)
+        self._open_data_changed(variable_ids)
+
         return True
 
     def unpublish(self):
+        changes = []
         for open_data in OpenData.objects.filter(source_survey=self.pk):
+            if open_data.is_active:
+                changes.append((open_data.id, OpenDataChange.DELETE))
             open_data.is_active = False
             open_data.date_modified = datetime.utcnow()
             open_data.save()
 
+        OpenDataChange.record(changes)
+        self._open_data_changed(self._open_data_variable_ids(), unpublished=True)
+
+    def _open_data_variable_ids(self):
+        return [open_data["variable"] for open_data in
+                OpenData.objects.filter(source_survey=self.pk).only("variable").as_pymongo()]
+
+    def _open_data_changed(self, variable_ids, unpublished=False):
+        NationalTotal.refresh(self.sample_year, variable_ids)
+        # The status of an unpublished survey is only changed and saved after unpublish returns
+        StatisticsCell.refresh(self.sample_year, self.library.municipality_code, self.library.library_type,
+                               excluded_survey=self.pk if unpublished else None)
+        Generation.bump(OpenData.GENERATION)
+        Generation.bump(OpenData.year_generation(self.sample_year))
+        CachedReport.evict(dependencies__in=self.report_dependency_keys())
+
     def __init__(self, *args, **kwargs):
         password = kwargs.pop("password", None)
         super(Survey, self).__init__(*args, **kwargs)
@@ -785,6 +1083,95 @@ class SurveyVersion(SurveyBase):
     }
 
 
+class CoReportingGraph(object):
+    """
+        Which surveys of a sample year report for which libraries, read with one projected query. Build it once
+        per request or job and pass it to the co-reporting methods of the surveys of that year, which otherwise
+        build their own.
+
+        With 'sigels' or 'municipality_codes' only the surveys selecting one of the sigels or in one of the
+        municipalities are read, which answers for the surveys with those sigels in those municipalities.
+    """
+    FIELDS = ("library.sigel", "library.municipality_code", "library.library_type", "selected_libraries")
+
+    def __init__(self, sample_year, sigels=None, municipality_codes=None):
+        self.sample_year = sample_year
+        self._by_municipality = {}
+        self._reporters = {}
+
+        query = {"sample_year": sample_year}
+        if sigels is not None or municipality_codes is not None:
+            query = {"$or": [
+                {"sample_year": sample_year, "selected_libraries": {"$in": list(sigels or [])}},
+                {"sample_year": sample_year, "library.municipality_code": {"$in": list(municipality_codes or [])}}
+            ]}
+        projection = dict((field, 1) for field in self.FIELDS)
+        for document in Survey._get_collection().find(query, projection):
+            library = document.get("library") or {}
+            node = (document["_id"], library.get("sigel"), library.get("library_type"),
+                    document.get("selected_libraries") or [])
+            self._by_municipality.setdefault(library.get("municipality_code"), []).append(node)
+            for sigel in set(node[3]):
+                self._reporters.setdefault(sigel, []).append(node)
+
+    def _others(self, survey):
+        """
+            The surveys of libraries in the same municipality and with the same principal as the survey's.
+        """
+        if not survey.library.municipality_code:
+            return []
+        library_types = get_library_types_with_same_principal(survey.library)
+        return [(pk, sigel, selected) for pk, sigel, library_type, selected
+                in self._by_municipality.get(survey.library.municipality_code, [])
+                if library_type in library_types and sigel != survey.library.sigel]
+
+    def selected_sigels_in_other_surveys(self, survey):
+        return Set(sigel for pk, other_sigel, selected in self._others(survey) for sigel in selected)
+
+    def has_conflicts(self, survey):
+        reported = Set(survey.selected_libraries)
+        reported.add(survey.library.sigel)
+        return any(sigel in reported for sigel in self.selected_sigels_in_other_surveys(survey))
+
+    def conflicting_survey_ids(self, survey):
+        return [pk for pk, other_sigel, selected in self._others(survey)
+                if any(sigel in selected for sigel in survey.selected_libraries)
+                or survey.library.sigel in selected]
+
+    def reported_by(self, survey):
+        return [sigel for pk, sigel, library_type, selected in self._reporters.get(survey.library.sigel, [])]
+
+    def is_reported_by_other(self, survey):
+        return any(pk != survey.pk for pk, sigel, library_type, selected
+                   in self._reporters.get(survey.library.sigel, []))
+
+    def is_co_reported_by_other(self, survey):
+        """
+            True for a survey without selected libraries whose library is selected in another survey.
+        """
+        return not survey.selected_libraries and survey.library.sigel in self._reporters
+
+    def flags(self, survey):
+        """
+            The co-reporting fields stored on the survey.
+        """
+        return {
+            "_reported_by": self.reported_by(survey),
+            "_is_reported_by_other": self.is_reported_by_other(survey),
+            "_is_reporting_for_others": survey.is_reporting_for_others(),
+            "_has_conflict": self.has_conflicts(survey),
+        }
+
+
+class CoReportingGraphs(dict):
+    """
+        The co-reporting graphs of several sample years, each built when first used.
+    """
+    def __missing__(self, sample_year):
+        graph = self[sample_year] = CoReportingGraph(sample_year)
+        return graph
+
+
 class Article(Document):
     title = StringField()
     content = StringField()
@@ -810,6 +1197,15 @@ class Dispatch(Document):
 
 
 class OpenData(Document):
+    GENERATION = u"open_data"
+    # Fields read by 'raw_to_dict'
+    RAW_FIELDS = ("library_name", "sigel", "sample_year", "target_group", "variable", "variable_key", "value",
+                  "date_created", "date_modified")
+
+    @classmethod
+    def year_generation(cls, sample_year):
+        return u"{}.{}".format(cls.GENERATION, sample_year)
+
     is_active = BooleanField(required=True, default=True) # Usage: False if source_survey has been unpublished, if source_survey.library is no longer in variable.target_group or if observation it's based on is no longer public
     source_survey = ReferenceField(Survey)
     library_name = StringField(required=True)
@@ -825,13 +1221,23 @@ class OpenData(Document):
     meta = {
         'collection': 'libstat_open_data',
         'ordering': ['-date_modified'],
+        'queryset_class': OpenDataQuerySet,
         'indexes': [
             "is_active",
             "source_survey",
             "variable",
             "variable_key",
             "sample_year",
-            "date_modified"
+            "date_modified",
+            # Keyset pagination of /data, see OpenDataQuerySet.DATA_API_INDEXES
+            ("is_active", "-date_modified", "-id"),
+            ("variable", "is_active", "-date_modified", "-id"),
+            ("sigel", "is_active", "-date_modified", "-id"),
+            ("sample_year", "target_group", "is_active", "-date_modified", "-id"),
+            ("sample_year", "is_active", "-date_modified", "-id"),
+            # Open data dumps in sigel order, see services.open_data_dump. Leaves out value, whose free text
+            # answers can exceed the index key size limit.
+            ("is_active", "sample_year", "sigel"),
         ]
     }
 
@@ -841,6 +1247,29 @@ class OpenData(Document):
     def date_modified_str(self):
         return self.date_modified.strftime(ISO8601_utc_format)
 
+    @classmethod
+    def raw_to_dict(cls, open_data):
+        """
+            Same as 'to_dict' for a raw document with the RAW_FIELDS, without dereferencing the variable.
+        """
+        variable_key = open_data.get("variable_key")
+        if variable_key is None:
+            variable_key = variable_registry.get_by_id(_reference_id(open_data["variable"])).key
+        sigel = open_data.get("sigel")
+        return {
+            u"@id": str(open_data["_id"]),
+            u"@type": u"Observation",
+            u"library": {
+                u"@id": u"{}/library/{}".format(settings.BIBDB_BASE_URL, sigel) if sigel else "",
+                u"name": open_data.get("library_name")
+            },
+            u"sampleYear": open_data.get("sample_year"),
+            u"targetGroup": targetGroups[open_data.get("target_group")],
+            variable_key: open_data.get("value"),
+            u"published": open_data["date_created"].strftime(ISO8601_utc_format),
+            u"modified": open_data["date_modified"].strftime(ISO8601_utc_format)
+        }
+
     def to_dict(self):
         return {
             u"@id": str(self.id),
@@ -868,6 +1297,264 @@ class OpenData(Document):
             self.variable_key = self.variable.key
 
 
+class OpenDataChange(Document):
+    """
+        Log of the open data changes made by publishing and unpublishing, read by the /data/changes feed. An
+        upsert means that the observation was created or changed, a delete that it was deactivated or deleted.
+        The sequence numbers are reserved from a shared counter, so they follow the order of the changes.
+    """
+    SEQUENCE = u"open_data_changes"
+    UPSERT = u"upsert"
+    DELETE = u"delete"
+
+    sequence = IntField(required=True, unique=True)
+    open_data = ObjectIdField(required=True)
+    operation = StringField(required=True, choices=(UPSERT, DELETE))
+    date_created = DateTimeField(required=True, default=datetime.utcnow)
+
+    meta = {
+        'collection': 'libstat_open_data_changes',
+        'ordering': ['sequence'],
+    }
+
+    @classmethod
+    def record(cls, changes):
+        """
+            Logs the (open data id, operation) changes in the given order.
+        """
+        if not changes:
+            return
+        date_created = datetime.utcnow()
+        cls.objects.insert([cls(sequence=sequence, open_data=open_data_id, operation=operation,
+                                date_created=date_created)
+                            for sequence, (open_data_id, operation) in
+                            zip(Generation.reserve(cls.SEQUENCE, len(changes)), changes)], load_bulk=False)
+
+    @classmethod
+    def changes_since(cls, sequence, limit):
+        """
+            Returns the first 'limit' changes after a sequence number as raw documents. The changes stop before
+            the first one younger than OPEN_DATA_CHANGES_DELAY_SECONDS, since a change with a lower sequence
+            number may still be being written by another process.
+        """
+        settled = datetime.utcnow() - timedelta(seconds=settings.OPEN_DATA_CHANGES_DELAY_SECONDS)
+        changes = []
+        for change in cls.objects.filter(sequence__gt=sequence).order_by("sequence").limit(limit).only(
+                "sequence", "open_data", "operation", "date_created").as_pymongo():
+            if change["date_created"] >= settled:
+                break
+            changes.append(change)
+        return changes
+
+
+class Artifact(Document):
+    """
+        Metadata of a generated file shared by all processes, such as a public export or an open data dump of a
+        sample year, see services.artifact_store. 'generation' is the open data generation the file was
+        generated for, 'location' where the backend stored it. 'replaced' holds the backend and location of
+        the files of the same generation it replaced, which are removed with the artifact.
+    """
+    kind = StringField(required=True)
+    year = IntField(required=True)
+    generation = IntField(required=True)
+    size = IntField(required=True)
+    checksum = StringField(required=True)
+    backend = StringField(required=True)
+    location = StringField(required=True)
+    replaced = ListField(DictField())
+    date_created = DateTimeField(required=True, default=datetime.utcnow)
+
+    meta = {
+        'collection': 'libstat_artifacts',
+        'indexes': [
+            {'fields': ['kind', 'year', '-generation'], 'unique': True},
+        ]
+    }
+
+    @classmethod
+    def current(cls, kind, year):
+        """
+            The artifact of the latest generation of a kind and year, or None.
+        """
+        return cls.objects.filter(kind=kind, year=year).order_by("-generation").first()
+
+
+class NationalTotal(Document):
+    """
+        Sum of the active, numeric open data values of a variable for a sample year. Kept up to date by
+        Survey.publish and Survey.unpublish, and rebuilt from open data with 'rebuild'.
+    """
+    variable_key = StringField(required=True)
+    variable = ObjectIdField()
+    sample_year = IntField(required=True)
+    value = FloatField(default=0.0)
+    count = IntField(default=0)
+
+    meta = {
+        'collection': 'libstat_national_totals',
+        'indexes': [
+            {'fields': ['sample_year', 'variable_key'], 'unique': True},
+        ],
+    }
+
+    @classmethod
+    def refresh(cls, sample_year, variable_ids):
+        variable_ids = list(set(filter(None, variable_ids)))
+        if not sample_year or not variable_ids:
+            return
+
+        sums = OpenData.objects.filter(sample_year=sample_year, is_active=True,
+                                       variable__in=variable_ids).sums_by_variable_and_year()
+        for variable_id in variable_ids:
+            variable = variable_registry.get_by_id(variable_id)
+            if variable is None:
+                continue
+            value, count = sums.get((variable_id, sample_year), (0, 0))
+            cls.objects.filter(sample_year=sample_year, variable_key=variable.key).update_one(
+                upsert=True, set__variable=variable_id, set__value=float(value), set__count=count)
+
+    @classmethod
+    def rebuild(cls, sample_year=None):
+        open_data = OpenData.objects.filter(is_active=True)
+        totals = cls.objects.all()
+        if sample_year:
+            open_data = open_data.filter(sample_year=sample_year)
+            totals = totals.filter(sample_year=sample_year)
+
+        national_totals = []
+        for (variable_id, year), (value, count) in open_data.sums_by_variable_and_year().iteritems():
+            variable = variable_registry.get_by_id(variable_id)
+            if variable is not None:
+                national_totals.append(cls(variable_key=variable.key, variable=variable_id, sample_year=year,
+                                           value=float(value), count=count))
+
+        totals.delete()
+        if national_totals:
+            cls.objects.insert(national_totals, load_bulk=False)
+        return len(national_totals)
+
+    @classmethod
+    def totals(cls, sample_year, variable_keys):
+        """
+            Returns {variable_key: total} for the given keys, keys without published values are left out.
+        """
+        return dict((total["variable_key"], total["value"]) for total in
+                    cls.objects.filter(sample_year=sample_year, variable_key__in=list(variable_keys)).only(
+                        "variable_key", "value").as_pymongo())
+
+
+class StatisticsCell(Document):
+    """
+        Pre-aggregated open data of the published surveys of one library type in one municipality and
+        sample year, per variable. 'incomplete' counts values that are not numbers. The cell without a
+        variable key counts the published surveys. Each (sample_year, municipality_code, library_type)
+        partition is recomputed by Survey.publish and Survey.unpublish.
+    """
+    sample_year = IntField(required=True)
+    variable_key = StringField()
+    municipality_code = StringField()
+    county = StringField()
+    library_type = StringField()
+    principal = StringField()
+    sum = FloatField(default=0.0)
+    count = IntField(default=0)
+    incomplete = IntField(default=0)
+
+    meta = {
+        'collection': 'libstat_statistics_cube',
+        'queryset_class': StatisticsCellQuerySet,
+        'indexes': [
+            {'fields': ['sample_year', 'variable_key', 'municipality_code', 'county', 'library_type', 'principal'],
+             'unique': True},
+            ('sample_year', 'variable_key', 'county'),
+            ('sample_year', 'variable_key', 'principal'),
+            ('sample_year', 'municipality_code', 'library_type'),
+        ],
+    }
+
+    @classmethod
+    def county_for(cls, municipality_code):
+        return municipality_code[0:2] + u"00" if municipality_code else None
+
+    @classmethod
+    def selection_keys(cls, sample_year, municipality_code, library_type):
+        """
+            Keys of the standard report selections (see 'selection_key') that contain a partition.
+        """
+        principal = principal_for_library_type.get(library_type)
+        return [cls.selection_key(sample_year, area, p)
+                for area in (municipality_code, cls.county_for(municipality_code), None)
+                for p in (principal, None)]
+
+    @classmethod
+    def selection_key(cls, sample_year, area=None, principal=None):
+        return u"{}:selection:{}:{}".format(sample_year, area or u"*", principal or u"*")
+
+    @classmethod
+    def selection_query(cls, area=None, principal=None):
+        query = {}
+        if area and area.endswith(u"00"):
+            query["county"] = area
+        elif area:
+            query["municipality_code"] = area
+        if principal:
+            query["principal"] = principal
+        return query
+
+    @classmethod
+    def refresh(cls, sample_year, municipality_code, library_type, excluded_survey=None):
+        if not sample_year:
+            return
+
+        survey_ids = [survey["_id"] for survey in Survey.objects.filter(
+            _status=u"published", sample_year=sample_year, library__municipality_code=municipality_code,
+            library__library_type=library_type).only("id").as_pymongo() if survey["_id"] != excluded_survey]
+
+        cells = {None: [0.0, len(survey_ids), 0]}
+        if survey_ids:
+            open_data = OpenData.objects.filter(source_survey__in=survey_ids, is_active=True)
+            for (variable_id, year), (value, count) in open_data.sums_by_variable_and_year().iteritems():
+                variable = variable_registry.get_by_id(variable_id)
+                if variable is not None:
+                    cell = cells.setdefault(variable.key, [0.0, 0, 0])
+                    cell[0] += value
+                    cell[1] += count
+            for od in open_data.non_numeric_values():
+                variable = variable_registry.get_by_id(od["variable"])
+                if variable is not None:
+                    cell = cells.setdefault(variable.key, [0.0, 0, 0])
+                    try:
+                        cell[0] += float(od.get("value"))
+                    except (TypeError, ValueError):
+                        cell[2] += 1
+
+        partition = cls.objects.filter(sample_year=sample_year, municipality_code=municipality_code,
+                                       library_type=library_type)
+        for variable_key, (value, count, incomplete) in cells.iteritems():
+            partition.filter(variable_key=variable_key).update_one(
+                upsert=True, set__county=cls.county_for(municipality_code),
+                set__principal=principal_for_library_type.get(library_type), set__sum=float(value),
+                set__count=count, set__incomplete=incomplete)
+        partition.filter(variable_key__nin=cells.keys()).delete()
+
+    @classmethod
+    def rebuild(cls, sample_year=None):
+        surveys = Survey.objects.filter(_status=u"published")
+        cells = cls.objects.all()
+        if sample_year:
+            surveys = surveys.filter(sample_year=sample_year)
+            cells = cells.filter(sample_year=sample_year)
+
+        partitions = set()
+        for survey in surveys.only("sample_year", "library.municipality_code", "library.library_type"):
+            partitions.add((survey.sample_year, survey.library.municipality_code, survey.library.library_type))
+
+        cells.delete()
+        for partition in partitions:
+            cls.refresh(*partition)
+        return len(partitions)
+
+
 class Cell(EmbeddedDocument):
     variable_key = StringField()
     required = BooleanField()
@@ -879,7 +1566,10 @@ class Cell(EmbeddedDocument):
 
     @property
     def variable(self):
-        self._variable = Variable.objects.no_cache().get(key=self.variable_key)
+        variable = variable_registry.get(self.variable_key)
+        if variable is None:
+            raise Variable.DoesNotExist(u"No variable with key {}".format(self.variable_key))
+        self._variable = variable
         return self._variable
 
     @property
@@ -956,20 +1646,113 @@ class SurveyTemplate(Document):
 
 
 class CachedReport(Document):
+    HITS = u"report_cache.hits"
+    MISSES = u"report_cache.misses"
+    EVICTIONS = u"report_cache.evictions"
+
+    key = StringField()
+    template = StringField()
     surveys = ListField(ReferenceField(Survey))
+    # Survey ids and library lookup keys (see Survey.library_keys) of the surveys and their lineage
+    dependencies = ListField(StringField())
+    data_generation = IntField()
+    variables_generation = IntField()
+    # Only set in stale-while-revalidate mode, where evicted reports are kept to be served while rebuilt
+    is_stale = BooleanField(default=False)
     report = DictField()
     year = IntField()
     date_created = DateTimeField(default=datetime.utcnow)
+    last_accessed = DateTimeField(default=datetime.utcnow)
 
     meta = {
         'collection': 'libstat_reports',
-        'ordering': ['-date_created'],
+        'ordering': ['-last_accessed'],
         'indexes': [
-            '-date_created',
+            # Sparse, reports cached before keys were introduced have none
+            {'fields': ['key'], 'unique': True, 'sparse': True},
+            '-last_accessed',
             'year',
+            'dependencies',
         ],
     }
 
+    @classmethod
+    def evict(cls, remove=False, **query):
+        """
+            Removes the matching reports, or in stale-while-revalidate mode marks them as stale unless 'remove'.
+        """
+        if getattr(settings, "REPORT_STALE_WHILE_REVALIDATE", False) and not remove:
+            result = cls._get_collection().update(cls.objects(is_stale__ne=True, **query)._query,
+                                                  {"$set": {"is_stale": True}}, multi=True)
+        else:
+            result = cls._get_collection().remove(cls.objects(**query)._query)
+        evicted = result.get("n", 0) if result else 0
+        if evicted:
+            Generation.bump(cls.EVICTIONS, evicted)
+        return evicted
+
+    @classmethod
+    def evict_least_recently_used(cls, limit, batch_size):
+        """
+            Removes at most 'batch_size' of the least recently accessed reports beyond 'limit'.
+        """
+        excess = cls.objects.count() - limit
+        if excess <= 0:
+            return 0
+        ids = list(cls.objects.order_by("last_accessed").limit(min(excess, batch_size)).scalar("id"))
+        return cls.evict(remove=True, id__in=ids)
+
+    @classmethod
+    def statistics(cls):
+        return {
+            u"hits": Generation.current(cls.HITS),
+            u"misses": Generation.current(cls.MISSES),
+            u"evictions": Generation.current(cls.EVICTIONS),
+        }
+
+
+class ReportLease(Document):
+    """
+        Held by the process computing a report, so that concurrent requests for the same report wait for it
+        instead of computing it too. Expires in case the holder dies.
+    """
+    key = StringField(required=True)
+    owner = StringField()
+    expires_at = DateTimeField()
+
+    meta = {
+        'collection': 'libstat_report_leases',
+        'indexes': [
+            {'fields': ['key'], 'unique': True},
+        ],
+    }
+
+    @classmethod
+    def acquire(cls, key, seconds):
+        """
+            Returns an owner token to release the lease with, or None if someone else holds it.
+        """
+        owner = unicode(ObjectId())
+        now = datetime.utcnow()
+        try:
+            # Matches an expired lease, or inserts one if there is none, the unique key index refuses the
+            # insert while someone holds it
+            cls._get_collection().update({"key": key, "expires_at": {"$lt": now}},
+                                         {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+                                         upsert=True)
+        except DuplicateKeyError:
+            return None
+        return owner
+
+    @classmethod
+    def release(cls, key, owner):
+        cls._get_collection().remove({"key": key, "owner": owner})
+
+    @classmethod
+    def is_held(cls, key):
+        return cls.objects.filter(key=key, expires_at__gte=datetime.utcnow()).count() > 0
+
+
 class SurveyEditingLock(Document):
     survey_id = ObjectIdField(required=True)
     date_locked = DateTimeField(required=True, default=datetime.utcnow)
@@ -999,7 +1782,10 @@ class SurveyEditingLock(Document):
 
 
 signals.pre_save.connect(Survey.pre_save, sender=Survey)
+signals.post_save.connect(Survey.post_save, sender=Survey)
+signals.post_delete.connect(Survey.post_delete, sender=Survey)
 signals.pre_save.connect(Variable.store_version_and_update_date_modified, sender=Variable)
 Variable.register_delete_rule(Variable, "replaced_by", NULLIFY)
 Variable.register_delete_rule(Variable, "replaces", PULL)
+signals.post_save.connect(Variable.post_save_actions, sender=Variable)
 signals.post_delete.connect(Variable.post_delete_actions, sender=Variable)
@@ -0,0 +1,10 @@
+# -*- coding: UTF-8 -*-
+
+
+def aggregate(queryset, pipeline):
+    """
+        Runs an aggregation pipeline on the collection of a query set and returns the result documents.
+    """
+    # Servers older than 2.6 ignore the cursor option and return the whole result in one document
+    result = queryset._collection.aggregate(pipeline, cursor={})
+    return result["result"] if isinstance(result, dict) else result
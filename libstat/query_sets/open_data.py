@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+from mongoengine import QuerySet
+
+from libstat.query_sets.aggregation import aggregate
+
+
+# BSON types that $sum adds up: double, 32-bit integer and 64-bit integer
+NUMERIC_BSON_TYPES = (1, 16, 18)
+
+
+def _date_ordered_index(*fields):
+    return [(field, 1) for field in fields] + [("is_active", 1), ("date_modified", -1), ("_id", -1)]
+
+
+class OpenDataQuerySet(QuerySet):
+    non_numeric_value_query = {"$nor": [{"value": {"$type": bson_type}} for bson_type in NUMERIC_BSON_TYPES]}
+
+    # Indexes serving the (-date_modified, -id) order of /data, by the equality filters they start with, most
+    # selective first
+    DATA_API_INDEXES = [
+        (("sigel",), _date_ordered_index("sigel")),
+        (("variable",), _date_ordered_index("variable")),
+        (("sample_year", "target_group"), _date_ordered_index("sample_year", "target_group")),
+        (("sample_year",), _date_ordered_index("sample_year")),
+    ]
+    DATA_API_DEFAULT_INDEX = _date_ordered_index()
+
+    def data_api_index(self, filters):
+        """
+            Returns the index of DATA_API_INDEXES to read /data with for the fields filtered on, or None when
+            the filters need an index that does not exist (for instance target_group on its own). Filters not
+            in the index are applied to the documents read in index order.
+        """
+        for fields, index in self.DATA_API_INDEXES:
+            if set(fields) <= set(filters):
+                return index
+        return None if filters else self.DATA_API_DEFAULT_INDEX
+
+    def sums_by_variable_and_year(self):
+        """
+            Sums the numeric values and counts all observations matching this query set, grouped by
+            variable id and sample year. Non-numeric values are counted but not summed, use
+            'non_numeric_values' to fetch them. Returns a dict {(variable_id, sample_year): (sum, count)}.
+        """
+        pipeline = [
+            {"$match": self._query},
+            {"$group": {
+                "_id": {"variable": "$variable", "sample_year": "$sample_year"},
+                "sum": {"$sum": "$value"},
+                "count": {"$sum": 1}
+            }}
+        ]
+        sums = {}
+        for row in aggregate(self, pipeline):
+            sums[(row["_id"]["variable"], row["_id"]["sample_year"])] = (row["sum"], row["count"])
+        return sums
+
+    def non_numeric_values(self):
+        """
+            Returns raw (variable, sample_year, value) documents for observations matching this query set
+            whose value is not stored as a number.
+        """
+        return self.filter(__raw__=self.non_numeric_value_query).only(
+            "variable", "sample_year", "value").as_pymongo()
@@ -0,0 +1,27 @@
+# -*- coding: UTF-8 -*-
+from mongoengine import QuerySet
+
+from libstat.query_sets.aggregation import aggregate
+
+
+class StatisticsCellQuerySet(QuerySet):
+    def totals_by_variable_and_year(self):
+        """
+            Adds up the cells matching this query set, grouped by variable key and sample year. Returns a
+            dict {(variable_key, sample_year): (sum, count, incomplete)}, where the variable key None holds
+            the number of published surveys.
+        """
+        pipeline = [
+            {"$match": self._query},
+            {"$group": {
+                "_id": {"variable_key": "$variable_key", "sample_year": "$sample_year"},
+                "sum": {"$sum": "$sum"},
+                "count": {"$sum": "$count"},
+                "incomplete": {"$sum": "$incomplete"}
+            }}
+        ]
+        totals = {}
+        for row in aggregate(self, pipeline):
+            key = (row["_id"].get("variable_key"), row["_id"]["sample_year"])
+            totals[key] = (row["sum"], row["count"], row["incomplete"])
+        return totals
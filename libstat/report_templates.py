@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
-from libstat.models import Variable
+import threading
+from collections import namedtuple
+
+from libstat.models import variable_registry
+
+
+def _compute(computation, values):
+    if values is None:
+        return None
+    if None in values:
+        return None
+    try:
+        return apply(computation, values)
+    except ZeroDivisionError:
+        return None
 
 
 class ReportTemplate():
     @property
     def all_variable_keys(self):
         variable_keys = []
+        seen = set()
         for group in self.groups:
             for row in group.rows:
-                if row.variable_key:
-                    if row.variable_key not in variable_keys:
-                        variable_keys.append(row.variable_key)
-                if row.variable_keys:
-                    for variable_key in row.variable_keys:
-                        if variable_key not in variable_keys:
-                            variable_keys.append(variable_key)
+                for variable_key in [row.variable_key] + (row.variable_keys or []):
+                    if variable_key and variable_key not in seen:
+                        seen.add(variable_key)
+                        variable_keys.append(variable_key)
         return variable_keys
 
     def __init__(self, *args, **kwargs):
@@ -31,14 +43,7 @@ class Group():
 
 class Row():
     def compute(self, values):
-        if values is None:
-            return None
-        if None in values:
-            return None
-        try:
-            return apply(self.computation, values)
-        except ZeroDivisionError:
-            return None
+        return _compute(self.computation, values)
 
     def __init__(self, *args, **kwargs):
         self.variable_key = kwargs.pop("variable_key", None)
@@ -51,17 +56,52 @@ class Row():
         self.percentage = kwargs.pop("percentage", False)
 
         if self.description is None and self.variable_key is not None:
-            variables = Variable.objects.filter(key=self.variable_key)
-            self.description = variables[0].question_part if len(variables) == 1 else None
+            variable = variable_registry.get(self.variable_key)
+            self.description = variable.question_part if variable else None
 
     @property
     def explanation(self):
         if self.variable_key:
-            variables = Variable.objects.filter(key=self.variable_key)
-            if len(variables) == 1:
-                return variables[0].description
+            variable = variable_registry.get(self.variable_key)
+            if variable:
+                return variable.description
         return None
 
+
+class CompiledReportTemplate(namedtuple("CompiledReportTemplate", ["kind", "groups", "all_variable_keys"])):
+    """Immutable snapshot of a report template, see compiled_report_template."""
+
+
+class CompiledGroup(namedtuple("CompiledGroup", ["title", "extra", "rows", "show_chart"])):
+    pass
+
+
+class CompiledRow(namedtuple("CompiledRow", ["variable_key", "variable_keys", "computation", "description",
+                                             "explanation", "is_sum", "label_only", "show_in_chart", "percentage"])):
+    def compute(self, values):
+        return _compute(self.computation, values)
+
+
+def _compile(kind, template):
+    groups = tuple(
+        CompiledGroup(title=group.title,
+                      extra=group.extra,
+                      show_chart=group.show_chart,
+                      rows=tuple(
+                          CompiledRow(variable_key=row.variable_key,
+                                      variable_keys=tuple(row.variable_keys) if row.variable_keys else None,
+                                      computation=row.computation,
+                                      description=row.description,
+                                      explanation=row.explanation,
+                                      is_sum=row.is_sum,
+                                      label_only=row.label_only,
+                                      show_in_chart=row.show_in_chart,
+                                      percentage=row.percentage)
+                          for row in group.rows))
+        for group in template.groups)
+    return CompiledReportTemplate(kind=kind, groups=groups, all_variable_keys=tuple(template.all_variable_keys))
+
+
 def report_template_base():
     return ReportTemplate(groups=[
         Group(title=u"Organisation",
@@ -2140,3 +2180,28 @@ def report_template_base_with_municipality_calculations():
                       show_in_chart=False),
                ]),
     ])
+
+
+REPORT_TEMPLATES = {
+    u"base": report_template_base,
+    u"target_group": report_template_base_with_target_group_calculations,
+    u"municipality": report_template_base_with_municipality_calculations,
+}
+
+_compiled_templates = {}
+_compile_lock = threading.Lock()
+
+
+def compiled_report_template(kind):
+    """
+        Returns the report template of the given kind (a key in REPORT_TEMPLATES) with descriptions,
+        explanations and variable keys resolved. It is built once per process and rebuilt only when
+        the variables have changed.
+    """
+    generation = variable_registry.generation
+    with _compile_lock:
+        compiled = _compiled_templates.get(kind)
+        if compiled is None or compiled[0] != generation:
+            compiled = (generation, _compile(kind, REPORT_TEMPLATES[kind]()))
+            _compiled_templates[kind] = compiled
+        return compiled[1]
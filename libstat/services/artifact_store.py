@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+import gridfs
+from bson import ObjectId
+from django.conf import settings
+
+from libstat.models import Artifact
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LocalArtifactStore(object):
+    """
+        Keeps artifacts as files in a local directory, which only the processes of one node share.
+    """
+    name = u"local"
+
+    def _dir_path(self):
+        if settings.ENVIRONMENT == "local":
+            return "{}/data/artifacts/".format(os.getcwd())
+        return "/data/appl/artifacts/"
+
+    def save(self, name, path):
+        if not os.path.isdir(self._dir_path()):
+            os.makedirs(self._dir_path())
+        # Moved next to its final name first, since a rename is only atomic within a file system
+        temporary_path = "{}{}.{}.tmp".format(self._dir_path(), name, uuid.uuid4().hex)
+        shutil.move(path, temporary_path)
+        os.rename(temporary_path, self._dir_path() + name)
+        return name
+
+    def open(self, location):
+        return open(self._dir_path() + location, "rb")
+
+    def delete(self, location):
+        if os.path.exists(self._dir_path() + location):
+            os.remove(self._dir_path() + location)
+
+
+class GridFSArtifactStore(object):
+    """
+        Keeps artifacts in GridFS, where all nodes using the database share them.
+    """
+    name = u"gridfs"
+    collection = "libstat_artifact_files"
+
+    def _fs(self):
+        return gridfs.GridFS(Artifact._get_db(), collection=self.collection)
+
+    def save(self, name, path):
+        with open(path, "rb") as f:
+            file_id = self._fs().put(f, filename=name, chunkSize=255 * 1024)
+        os.remove(path)
+        return str(file_id)
+
+    def open(self, location):
+        return self._fs().get(ObjectId(location))
+
+    def delete(self, location):
+        self._fs().delete(ObjectId(location))
+
+
+backends = dict((backend.name, backend) for backend in (LocalArtifactStore(), GridFSArtifactStore()))
+
+
+def _checksum_and_size(path):
+    checksum = hashlib.sha1()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+            checksum.update(chunk)
+            size += len(chunk)
+    return checksum.hexdigest(), size
+
+
+def store_artifact(kind, year, generation, path):
+    """
+        Moves the file at 'path' into the backend of the ARTIFACT_STORE setting and saves its metadata, which
+        makes it the current artifact of its kind and year. An artifact of the same generation and checksum is
+        kept as it is. Artifacts of older generations are removed, except the one replaced, which a request
+        may still be reading. Files replaced within a generation are removed with their artifact, for the same
+        reason. Returns the Artifact.
+    """
+    backend = backends[settings.ARTIFACT_STORE]
+    checksum, size = _checksum_and_size(path)
+    name = u"{}_{}_g{}_{}".format(kind, year, generation, checksum)
+    location = backend.save(name, path)
+
+    query = {"kind": kind, "year": year, "generation": generation}
+    previous = Artifact.objects.filter(**query).first()
+    if previous and previous.checksum == checksum:
+        if (previous.backend, previous.location) != (backend.name, location):
+            backend.delete(location)
+        return previous
+
+    # The document as it was before, also when another process replaced it in between
+    replaced = Artifact._get_collection().find_and_modify(query, {"$set": {
+        "size": size, "checksum": checksum, "backend": backend.name, "location": location,
+        "date_created": datetime.utcnow()}}, upsert=True, new=False)
+    if replaced and (replaced["backend"], replaced["location"]) != (backend.name, location):
+        Artifact._get_collection().update(query, {"$push": {"replaced": {
+            "backend": replaced["backend"], "location": replaced["location"]}}})
+
+    for older in Artifact.objects.filter(kind=kind, year=year, generation__lt=generation).order_by(
+            "-generation")[1:]:
+        for stored in [{"backend": older.backend, "location": older.location}] + older.replaced:
+            backends[stored["backend"]].delete(stored["location"])
+        older.delete()
+    logger.info(u"Stored {} artifact for {} generation {} ({} bytes)".format(kind, year, generation, size))
+    return Artifact.objects.get(kind=kind, year=year, generation=generation)
+
+
+def open_artifact(artifact):
+    """
+        The stored file of an artifact, open for reading.
+    """
+    return backends[artifact.backend].open(artifact.location)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+import uuid
+import logging
+
+import numpy
+
+from data.principals import principal_for_library_type
+from libstat.models import Survey, OpenData, NationalTotal, StatisticsCell
+from libstat.report_templates import compiled_report_template
+from libstat.services.report_generation import (template_kind_for_library_types, variables_for_keys,
+                                                is_variable_to_be_included, report_dependencies)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _compute_all(computation, columns):
+    # Elementwise version of report_templates._compute: missing values and divisions by zero give NaN
+    with numpy.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        result = numpy.asarray(computation(*columns), dtype=float)
+    return numpy.where(numpy.isfinite(result), result, numpy.nan)
+
+
+def _diffs(values0, values1, totals):
+    both_zero = (values0 == 0) & (values1 == 0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        diff = numpy.where(both_zero, 0.0,
+                           numpy.where(~numpy.isnan(values0) & ~numpy.isnan(values1) & (values1 != 0),
+                                       ((values0 / values1) - 1) * 100, numpy.nan))
+        nation_diff = numpy.where(both_zero, 0.0,
+                                  numpy.where(~numpy.isnan(values0) & ~numpy.isnan(totals) & (totals != 0),
+                                              (values0 / totals) * 1000, numpy.nan))
+    return diff, nation_diff
+
+
+def _value(value):
+    return None if numpy.isnan(value) else float(value)
+
+
+class ReportBatch(object):
+    """
+        Generates the reports of many standard selections (see report_generation.standard_selection) of a
+        sample year at once. The published surveys and the open data of the year and the two years before
+        are loaded once into (survey x variable) arrays. Sums, key figures and diffs are then computed for
+        all selections using the same template in one vectorized pass. As in 'get_report', the previous years
+        of a selection are the predecessors of its surveys (see Survey.previous_years_surveys), and the
+        reports are the same as the ones 'get_report' returns for those selections.
+    """
+
+    def __init__(self, year):
+        self.year = year
+        self.years = (year, year - 1, year - 2)
+
+        surveys = list(Survey.objects.filter(_status=u"published", sample_year__in=list(self.years)).only(
+            "sample_year", "library.sigel", "library.municipality_code", "library.library_type",
+            "selected_libraries").as_pymongo())
+        self.survey_ids = [survey["_id"] for survey in surveys]
+        self.survey_index = dict((survey_id, index) for index, survey_id in enumerate(self.survey_ids))
+        libraries = [survey.get("library", {}) for survey in surveys]
+        self.sample_years = numpy.array([survey.get("sample_year") for survey in surveys], dtype=object)
+        self.sigels = numpy.array([library.get("sigel") for library in libraries], dtype=object)
+        self.municipality_codes = numpy.array([library.get("municipality_code") for library in libraries],
+                                              dtype=object)
+        self.counties = numpy.array([StatisticsCell.county_for(code) for code in self.municipality_codes],
+                                    dtype=object)
+        self.library_types = numpy.array([library.get("library_type") for library in libraries], dtype=object)
+        self.principals = numpy.array([principal_for_library_type.get(library_type)
+                                       for library_type in self.library_types], dtype=object)
+        self.selected_libraries = [survey.get("selected_libraries", []) for survey in surveys]
+
+        # The index of each survey's predecessor per previous year, -1 when there is none
+        current_surveys = list(Survey.objects.filter(_status=u"published", sample_year=year).only(
+            "sample_year", "library.sigel", "library.name"))
+        self.surveys = dict((survey.pk, survey) for survey in current_surveys)
+        self.lineages = dict(zip([survey.pk for survey in current_surveys],
+                                 Survey.previous_years_surveys(current_surveys, years=2)))
+        self.predecessors = {}
+        for previous_year in self.years[1:]:
+            self.predecessors[previous_year] = numpy.empty(len(self.survey_ids), dtype=int)
+            self.predecessors[previous_year].fill(-1)
+        for survey_id, lineage in self.lineages.iteritems():
+            for previous_year, previous in zip(self.years[1:], lineage):
+                self.predecessors[previous_year][self.survey_index[survey_id]] = self.survey_index[previous.pk]
+
+        self.libraries_for_sigel = {}
+        for survey in Survey.objects.filter(sample_year=year).only("library").as_pymongo():
+            library = survey.get("library", {})
+            self.libraries_for_sigel.setdefault(library.get("sigel"), []).append(library)
+
+    def selection_mask(self, area=None, principal=None):
+        mask = numpy.ones(len(self.survey_ids), dtype=bool)
+        for field, value in StatisticsCell.selection_query(area, principal).iteritems():
+            mask &= {u"county": self.counties, u"municipality_code": self.municipality_codes,
+                     u"principal": self.principals}[field] == value
+        return mask
+
+    def year_mask(self, year):
+        return self.sample_years == year
+
+    def survey_ids_for(self, selection):
+        return [self.survey_ids[index] for index in
+                numpy.flatnonzero(self.selection_mask(*selection) & self.year_mask(self.year))]
+
+    def sigels_for(self, selection):
+        return list(self.sigels[self.selection_mask(*selection) & self.year_mask(self.year)])
+
+    def dependencies_for(self, selection):
+        """
+            The report dependencies of a selection, as 'build_report' stores them for its surveys.
+        """
+        surveys = [self.surveys[survey_id] for survey_id in self.survey_ids_for(selection)]
+        return (report_dependencies(surveys, [self.lineages[survey.pk] for survey in surveys]) +
+                [StatisticsCell.selection_key(self.year, *selection)])
+
+    def library_types_for(self, selection):
+        return list(self.library_types[self.selection_mask(*selection) & self.year_mask(self.year)])
+
+    def template_kind(self, selection):
+        return template_kind_for_library_types(self.library_types_for(selection))
+
+    def generate(self, selections):
+        """
+            Returns {selection: report} for the (area, principal) selections that have published surveys in
+            the sample year.
+        """
+        masks = {}
+        selections_for_kind = {}
+        for selection in selections:
+            if self.library_types_for(selection):
+                masks[selection] = self.selection_mask(*selection)
+                selections_for_kind.setdefault(self.template_kind(selection), []).append(selection)
+
+        templates = dict((kind, compiled_report_template(kind)) for kind in selections_for_kind)
+        variables_for_key = {}
+        for template in templates.values():
+            variables_for_key.update(variables_for_keys(template))
+        self._load_values(variables_for_key)
+
+        reports = {}
+        for kind, kind_selections in selections_for_kind.iteritems():
+            template = templates[kind]
+            observations = self._observations(numpy.array([masks[s] for s in kind_selections]))
+            measurements = self._measurements(template, observations,
+                                              [list(set(self.library_types[masks[s] & self.year_mask(self.year)]))
+                                               for s in kind_selections])
+            for index, selection in enumerate(kind_selections):
+                reports[selection] = {
+                    "id": str(uuid.uuid1()),
+                    "year": self.year,
+                    "libraries": self._libraries(masks[selection]),
+                    "measurements": measurements[index]
+                }
+        return reports
+
+    def _load_values(self, variables_for_key):
+        """
+            Loads the open data of all surveys into (survey x variable) arrays of summed values, number of
+            values and number of values that are not numbers, and a (variable x key) matrix adding replaced
+            variables to the keys replacing them.
+        """
+        self.keys = sorted(variables_for_key.keys())
+        variable_ids = sorted(set(variable.id for variables in variables_for_key.values() for variable in variables))
+        variable_index = dict((variable_id, index) for index, variable_id in enumerate(variable_ids))
+
+        self.variables_to_keys = numpy.zeros((len(variable_ids), len(self.keys)))
+        for key_index, key in enumerate(self.keys):
+            for variable in variables_for_key[key]:
+                self.variables_to_keys[variable_index[variable.id], key_index] = 1
+        self.total_keys = dict((key, [variable.key for variable in variables_for_key[key]]) for key in self.keys)
+
+        shape = (len(self.survey_ids), len(variable_ids))
+        self.sums = numpy.zeros(shape)
+        self.counts = numpy.zeros(shape)
+        self.unparsable = numpy.zeros(shape)
+
+        open_data = OpenData.objects.filter(sample_year__in=list(self.years), is_active=True,
+                                            variable__in=variable_ids).only("source_survey", "variable", "value")
+        for od in open_data.as_pymongo():
+            survey_index = self.survey_index.get(od.get("source_survey"))
+            if survey_index is None:
+                continue
+            index = (survey_index, variable_index[od["variable"]])
+            self.counts[index] += 1
+            try:
+                self.sums[index] += float(od.get("value"))
+            except (TypeError, ValueError):
+                self.unparsable[index] += 1
+
+    def _observations(self, masks):
+        """
+            Sums the values of each selection per key and year, see report_generation.cube_observations.
+            Returns a dict with (selections x keys) arrays per year of values (NaN when missing) and of
+            incomplete flags, and the national totals per key.
+        """
+        sums = self.sums.dot(self.variables_to_keys)
+        counts = self.counts.dot(self.variables_to_keys)
+        unparsable = self.unparsable.dot(self.variables_to_keys)
+
+        observations = {"values": {}, "incomplete": {}}
+        for year in self.years:
+            year_masks, number_of_surveys = self._year_masks(masks, year)
+            year_sums = year_masks.dot(sums)
+            year_counts = year_masks.dot(counts)
+            observations["values"][year] = numpy.where((year_sums != 0) & (year_counts != 0), year_sums, numpy.nan)
+            observations["incomplete"][year] = (year_masks.dot(unparsable) > 0) | (year_counts < number_of_surveys)
+
+        national_totals = NationalTotal.totals(self.year, set(key for keys in self.total_keys.values() for key in keys))
+        observations["totals"] = numpy.array([float(sum(national_totals.get(key, 0) for key in self.total_keys[k]))
+                                              for k in self.keys])
+        return observations
+
+    def _year_masks(self, masks, year):
+        """
+            Returns the (selections x surveys) masks of the surveys read for a year and the number of surveys
+            per selection. Previous years are the predecessors of the selections' surveys in the sample year.
+        """
+        current_masks = masks & self.year_mask(self.year)
+        if year == self.year:
+            return current_masks.astype(float), current_masks.sum(axis=1)[:, numpy.newaxis]
+
+        year_masks = numpy.zeros(masks.shape)
+        number_of_surveys = numpy.zeros((len(masks), 1))
+        for index, current_mask in enumerate(current_masks):
+            predecessors = self.predecessors[year][current_mask]
+            predecessors = predecessors[predecessors >= 0]
+            year_masks[index, predecessors] = 1
+            number_of_surveys[index] = len(predecessors)
+        return year_masks, number_of_surveys
+
+    def _measurements(self, template, observations, library_types):
+        key_index = dict((key, index) for index, key in enumerate(self.keys))
+        number_of_selections = len(library_types)
+        missing = numpy.empty(number_of_selections)
+        missing.fill(numpy.nan)
+        years = self.years
+        year0, year1, year2 = [str(year) for year in years]
+
+        def column(key, year):
+            if key not in key_index:
+                return missing
+            return observations["values"][year][:, key_index[key]]
+
+        def incomplete_years(keys, index):
+            return [year for year in years for key in keys
+                    if key in key_index and observations["incomplete"][year][index, key_index[key]]]
+
+        measurements = [[] for _ in range(number_of_selections)]
+        for template_group in template.groups:
+            groups = [{
+                "title": template_group.title,
+                "years": [year2, year1, year0],
+                "rows": [],
+                "extra": template_group.extra,
+                "show_chart": template_group.show_chart
+            } for _ in range(number_of_selections)]
+
+            for template_row in template_group.rows:
+                variable_row = key_figure_row = None
+
+                if template_row.variable_key:
+                    values = [column(template_row.variable_key, year) for year in years]
+                    if template_row.variable_key in key_index:
+                        totals = numpy.empty(number_of_selections)
+                        totals.fill(observations["totals"][key_index[template_row.variable_key]])
+                    else:
+                        totals = missing
+                    extra = (_compute_all(template_row.computation,
+                                          [column(key, years[0]) for key in template_row.variable_keys]) * 100
+                             if template_row.computation else missing)
+                    variable_row = (values, totals, extra) + _diffs(values[0], values[1], totals)
+
+                if template_row.variable_keys:
+                    values = [_compute_all(template_row.computation,
+                                           [column(key, year) for key in template_row.variable_keys])
+                              for year in years]
+                    key_figure_row = (values,) + _diffs(values[0], values[1], missing)
+
+                for index in range(number_of_selections):
+                    row = self._row(template_row, index, library_types[index], variable_row, key_figure_row,
+                                    incomplete_years)
+                    if row:
+                        groups[index]["rows"].append(row)
+
+            for index, group in enumerate(groups):
+                measurements[index].append(dict((k, v) for k, v in group.iteritems() if v is not None))
+        return measurements
+
+    def _row(self, template_row, index, library_types, variable_row, key_figure_row, incomplete_years):
+        # Mirrors the row logic of report_generation.generate_report
+        year0, year1, year2 = [str(year) for year in self.years]
+        row = {
+            "description": template_row.explanation,
+            "show_in_chart": template_row.show_in_chart if template_row.variable_key else False,
+            "is_sum": template_row.is_sum if template_row.is_sum else None,
+            "label": template_row.description,
+            "label_only": template_row.label_only if template_row.label_only else None,
+            "percentage": template_row.percentage if template_row.percentage else None
+        }
+
+        if template_row.variable_key and is_variable_to_be_included(template_row.variable_key, library_types):
+            values, totals, extra, diff, nation_diff = variable_row
+            incomplete_data = (incomplete_years([template_row.variable_key], index)
+                               if template_row.variable_key in self.total_keys else None)
+            row["extra"] = _value(extra[index])
+        elif template_row.variable_keys and all(is_variable_to_be_included(variable_key, library_types)
+                                                for variable_key in template_row.variable_keys):
+            values, diff, nation_diff = key_figure_row
+            incomplete_data = []
+            for year in incomplete_years(template_row.variable_keys, index):
+                if year not in incomplete_data:
+                    incomplete_data.append(year)
+            row["is_key_figure"] = True
+        elif not template_row.variable_key and not template_row.variable_keys:
+            values = diff = nation_diff = None
+            incomplete_data = []
+        else:
+            return None
+
+        if values is not None:
+            row[year0], row[year1], row[year2] = [_value(year_values[index]) for year_values in values]
+            row["diff"] = _value(diff[index])
+            row["nation_diff"] = _value(nation_diff[index])
+        row["incomplete_data"] = [str(year) for year in incomplete_data] if incomplete_data else None
+        return dict((k, v) for k, v in row.iteritems() if v is not None)
+
+    def _libraries(self, mask):
+        sigels = set(sigel for index in numpy.flatnonzero(mask & self.year_mask(self.year))
+                     for sigel in self.selected_libraries[index])
+        libraries = [library for sigel in sigels for library in self.libraries_for_sigel.get(sigel, [])]
+        libraries.sort(key=lambda library: library.get("name", u"").lower())
+        return [{
+            "sigel": library.get("sigel"),
+            "name": library.get("name"),
+            "address": library.get("address"),
+            "city": library.get("city")
+        } for library in libraries]
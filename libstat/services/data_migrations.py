@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from pymongo.errors import OperationFailure
+
+from libstat.models import Survey, OpenData, Generation, NationalTotal, StatisticsCell
+
+
+logger = logging.getLogger(__name__)
+
+GENERATION = "data_migrations"
+
+
+def store_co_reporting():
+    for sample_year in sorted(Survey.objects.distinct("sample_year")):
+        changed = Survey.update_co_reporting(sample_year)
+        logger.info(u"...co-reporting of {} surveys for {} updated".format(len(changed), sample_year))
+
+
+def drop_open_data_dump_index_with_value():
+    # Free text values over the index key size limit could not be published with value in the index
+    try:
+        OpenData._get_collection().drop_index(
+            [(field, 1) for field in
+             ("is_active", "sample_year", "sigel", "variable_key", "library_name", "target_group", "value")])
+    except OperationFailure:
+        logger.info(u"...no open data dump index with value to drop")
+
+
+# Run in this order, once per database. Only add migrations at the end.
+MIGRATIONS = [
+    (u"Store co-reporting on all surveys", store_co_reporting),
+    (u"Drop the open data dump index with value", drop_open_data_dump_index_with_value),
+    (u"Build the national totals", NationalTotal.rebuild),
+    (u"Build the statistics cube", StatisticsCell.rebuild),
+]
+
+
+def migrate():
+    """
+        Runs the data migrations not yet run on the database, counted by the 'data_migrations' generation.
+        Returns the number of migrations run.
+    """
+    applied = Generation.current(GENERATION)
+    for number, (description, migration) in enumerate(MIGRATIONS[applied:], applied + 1):
+        logger.info(u"Running data migration {}: {}".format(number, description))
+        migration()
+        Generation.bump(GENERATION)
+    return max(len(MIGRATIONS) - applied, 0)
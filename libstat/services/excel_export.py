@@ -4,18 +4,24 @@ import glob
 import os
 import datetime
 import math
-from django.core.files import File
+import tempfile
+import threading
+from itertools import groupby
 
 from openpyxl import Workbook, load_workbook
-from openpyxl.writer.excel import save_virtual_workbook
 from bibstat import settings
 
 from data.principals import principal_for_library_type
-from libstat.models import Survey, OpenData, Variable, Library
+from libstat.models import (Survey, OpenData, Library, Artifact, Generation, ReportLease, CoReportingGraphs,
+                            variable_registry)
+from libstat.services.artifact_store import store_artifact
+from libstat.services.open_data_dump import DUMP_INDEX
 
 import logging
 
 DATE_FORMAT = "%Y_%m_%d_%H_%M_%S"
+EXPORT_LEASE_SECONDS = 600
+PUBLIC_EXPORT = u"public_export"
 
 
 logger = logging.getLogger(__name__)
@@ -54,70 +60,131 @@ def _cache_workbook(workbook, year, file_name_str="public_export_{} {}.xslx", wo
         if ".xslx" in filename:
             if (workbook_is_public == True and filename.startswith("public")) or (workbook_is_public == False and filename.startswith("survey")):
                 os.remove("%s%s" % (_cache_dir_path(), filename))
-    with open(_cache_path(year, file_name_str, datetime.datetime.utcnow().strftime(DATE_FORMAT)), "w") as f:
-        File(f).write(save_virtual_workbook(workbook))
-
-
-def public_excel_workbook(year):
-    if not _cached_workbook_exists_and_is_valid(year):
-        _cache_workbook(_published_open_data_as_workbook(year), year)
-    return sorted(glob.glob(_cache_path(year)))[-1]
+    workbook.save(_cache_path(year, file_name_str, datetime.datetime.utcnow().strftime(DATE_FORMAT)))
+
+
+def write_public_export(year):
+    """
+        Writes the public export of a year for the current open data generation of the year to a temporary
+        file and stores it as the current PUBLIC_EXPORT artifact of the year. Returns the Artifact.
+    """
+    generation = Generation.current(OpenData.year_generation(year))
+    f, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(f)
+    try:
+        _published_open_data_as_workbook(year).save(path)
+        return store_artifact(PUBLIC_EXPORT, year, generation, path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def regenerate_public_export(year):
+    """
+        Writes the public export of a year unless another process or thread is already doing it. Returns the
+        Artifact, or None when the export was left to the other writer.
+    """
+    key = u"public_export:{}".format(year)
+    owner = ReportLease.acquire(key, EXPORT_LEASE_SECONDS)
+    if not owner:
+        return None
+    try:
+        return write_public_export(year)
+    finally:
+        ReportLease.release(key, owner)
+
+
+def public_export_artifact(year):
+    """
+        A ready public export of a year. When the open data of the year has changed since the newest export
+        was written, that export is returned while a new one is written in the background. Only a year
+        without any export has it written in the request.
+    """
+    artifact = Artifact.current(PUBLIC_EXPORT, year)
+    if not artifact:
+        return write_public_export(year)
+
+    if artifact.generation != Generation.current(OpenData.year_generation(year)):
+        thread = threading.Thread(target=regenerate_public_export, args=(year,))
+        thread.daemon = True
+        thread.start()
+    return artifact
+
+
+_END = object()
+
+
+def _open_data_by_sigel(year, variable_keys):
+    """
+        Yields (sigel, {variable_key: value}) for the active open data of a year in sigel order, one library at
+        a time, read in the order of the index of the open data dumps.
+    """
+    rows = OpenData._get_collection().find(
+        {"is_active": True, "sample_year": year, "variable_key": {"$in": variable_keys}},
+        {"_id": 0, "sigel": 1, "variable_key": 1, "value": 1}).hint(DUMP_INDEX).sort("sigel", 1)
+    for sigel, library_rows in groupby(rows, key=lambda row: row.get("sigel")):
+        yield sigel, dict((row.get("variable_key"), row.get("value")) for row in library_rows)
+
+
+def _libraries_by_sigel(year):
+    """
+        Yields (sigel, library) for the surveys of a year in sigel order, from the first survey of each library.
+    """
+    surveys = Survey.objects.filter(sample_year=year).order_by("library.sigel").only("library").as_pymongo()
+    for sigel, library_surveys in groupby(surveys, key=lambda survey: survey.get("library", {}).get("sigel")):
+        yield sigel, next(library_surveys)["library"]
+
+
+def _published_open_data_rows(year, variable_keys):
+    """
+        Yields the rows of the public export, joining the open data and the libraries of a year on sigel.
+    """
+    libraries = _libraries_by_sigel(year)
+    library_sigel, library = next(libraries, (_END, None))
+    for sigel, values in _open_data_by_sigel(year, variable_keys):
+        while library_sigel is not _END and library_sigel < sigel:
+            library_sigel, library = next(libraries, (_END, None))
+        if library_sigel != sigel:
+            continue  # KP 180419
+
+        external_identifiers = library.get("external_identifiers") or []
+        row = [
+            library.get("name"),
+            sigel if year >= 2014 else "",  # Do not show auto-generated sigels (used before 2014)
+            library.get("library_type"),
+            library.get("municipality_code"),
+            library.get("city"),
+            (external_identifiers[0].get("identifier") or "") if external_identifiers else ""
+        ]
+        yield row + [values.get(key) for key in variable_keys]
 
 
 def _published_open_data_as_workbook(year):
-    workbook = Workbook(encoding="utf-8")
-    worksheet = workbook.active
-    worksheet.title = u"Värden"
-
-    public_variables = list(Variable.objects.filter(is_public=True).distinct("key"))
-
-    variable_keys = list(OpenData.objects.filter(is_active=True, sample_year=year, variable_key__in=public_variables).distinct("variable_key"))
-    sigels = list(OpenData.objects.filter(is_active=True, sample_year=year, variable_key__in=public_variables).distinct("sigel"))
-
-    libraries = {}
-    for sigel in sigels:
-        libraries[sigel] = dict.fromkeys(variable_keys)
-
-    for open_data in OpenData.objects.filter(is_active=True, sample_year=year, variable_key__in=public_variables).only("library_name", "variable_key", "sigel", "value"):
-        libraries[open_data.sigel][open_data.variable_key] = open_data.value
-
-    header = ["Bibliotek", "Sigel", "Bibliotekstyp", "Kommunkod", "Stad", "Externt id"]
-    variable_index = {}
-    for index, key in enumerate(variable_keys):
-        variable_index[key] = index + 6
-        header.append(key)
-    worksheet.append(header)
-
-    for sigel in libraries:
-        #library = Survey.objects.filter(library__sigel=sigel, sample_year=year).first().library
-        library = Survey.objects.filter(library__sigel=sigel, sample_year=year).first()
-        if library != None:
-            library = library.library
-        else:
-            continue # KP 180419
-        row = [""] * len(header)
-        row[0] = library.name
-        row[1] = sigel if year >= 2014 else ""  # Do not show auto-generated sigels (used before 2014)
-        row[2] = library.library_type
-        row[3] = library.municipality_code
-        row[4] = library.city
-        row[5] = library.external_identifiers[0].identifier if library.external_identifiers and len(library.external_identifiers) > 0 and library.external_identifiers[0].identifier else ""
-
-        for key in variable_keys:
-            row[variable_index[key]] = libraries[sigel][key]
+    """
+        Builds the public export of a year in a write-only workbook, whose rows are written to a temporary file
+        as they are appended, so that memory use does not grow with the number of libraries.
+    """
+    workbook = Workbook(write_only=True, encoding="utf-8")
+    worksheet = workbook.create_sheet(title=u"Värden")
+
+    public_variables = [variable.key for variable in variable_registry.all() if variable.is_public]
+    variable_keys = sorted(OpenData.objects.filter(is_active=True, sample_year=year, variable_key__in=public_variables).distinct("variable_key"))
+
+    worksheet.append(["Bibliotek", "Sigel", "Bibliotekstyp", "Kommunkod", "Stad", "Externt id"] + variable_keys)
+    for row in _published_open_data_rows(year, variable_keys):
         worksheet.append(row)
 
-    variable_sheet = workbook.create_sheet()
-    variable_sheet.title = u"Definitioner"
-    for variable in Variable.objects.filter(key__in=variable_keys):
-        variable_sheet.append([variable.key, variable.description])
+    variable_sheet = workbook.create_sheet(title=u"Definitioner")
+    for key in variable_keys:
+        variable_sheet.append([key, variable_registry.get(key).description])
 
     return workbook
 
 
-def _populate_survey_cells(survey, worksheet, headers_columns_dict, row_no):
+def _populate_survey_cells(survey, worksheet, headers_columns_dict, row_no, co_reporting_graphs):
     if not survey:
         return
+    co_reporting = co_reporting_graphs[survey.sample_year]
     worksheet.cell(row=row_no, column=headers_columns_dict["År"]).value = survey.sample_year
     worksheet.cell(row=row_no, column=headers_columns_dict["Bibliotek"]).value = survey.library.name
     worksheet.cell(row=row_no, column=headers_columns_dict["Sigel"]).value = survey.library.sigel
@@ -129,10 +196,10 @@ def _populate_survey_cells(survey, worksheet, headers_columns_dict, row_no):
     worksheet.cell(row=row_no, column=headers_columns_dict["Adress"]).value = survey.library.address
     worksheet.cell(row=row_no, column=headers_columns_dict["Postkod"]).value = survey.library.zip_code
     worksheet.cell(row=row_no, column=headers_columns_dict["Huvudman"]).value = principal_for_library_type[survey.library.library_type] if survey.library.library_type in principal_for_library_type else None
-    worksheet.cell(row=row_no, column=headers_columns_dict["Kan publiceras?"]).value = "Ja" if survey.can_publish() else "Nej: " + survey.reasons_for_not_able_to_publish()
+    worksheet.cell(row=row_no, column=headers_columns_dict["Kan publiceras?"]).value = "Ja" if survey.can_publish(co_reporting) else "Nej: " + survey.reasons_for_not_able_to_publish(co_reporting)
     worksheet.cell(row=row_no, column=headers_columns_dict["Samredovisar andra bibliotek"]).value = "Ja" if survey.is_reporting_for_others() else "Nej"
-    worksheet.cell(row=row_no, column=headers_columns_dict["Samredovisas"]).value = "Ja" if survey.is_reported_by_other() else "Nej"
-    worksheet.cell(row=row_no, column=headers_columns_dict["Redovisas av"]).value = ",".join(survey.reported_by())
+    worksheet.cell(row=row_no, column=headers_columns_dict["Samredovisas"]).value = "Ja" if survey.is_reported_by_other(co_reporting) else "Nej"
+    worksheet.cell(row=row_no, column=headers_columns_dict["Redovisas av"]).value = ",".join(survey.reported_by(co_reporting))
 
     for observation in survey.observations:
         variable_key = observation.variable.key
@@ -155,20 +222,29 @@ def _load_surveys_and_append_worksheet_rows(
     surveys,
     worksheet,
     headers_columns_dict,
+    co_reporting_graphs,
     offset=0,
     include_previous_year=False
 ):
     row_no = 2 + offset
-    for survey in surveys:
-        _populate_survey_cells(survey, worksheet, headers_columns_dict, row_no)
+    surveys = list(surveys)
+    previous_surveys = [None] * len(surveys)
+    if include_previous_year:
+        previous_survey_ids = [ids[0] if ids else None for ids in Survey.previous_years_survey_ids(surveys)]
+        found = Survey.objects.in_bulk([pk for pk in previous_survey_ids if pk])
+        previous_surveys = [found.get(pk) for pk in previous_survey_ids]
+
+    for index, survey in enumerate(surveys):
+        _populate_survey_cells(survey, worksheet, headers_columns_dict, row_no, co_reporting_graphs)
         if include_previous_year:
-            previous = survey.previous_years_survey()
+            previous = previous_surveys[index]
             if previous:
                 _populate_survey_cells(
                     previous,
                     worksheet,
                     headers_columns_dict,
                     row_no + 1,
+                    co_reporting_graphs
                 )
             row_no += 2
         else:
@@ -211,6 +287,8 @@ def surveys_to_excel_workbook(survey_ids, include_previous_year=False):
     worksheet = workbook.active
     worksheet.append(headers)
 
+    # Shared by all rows, the surveys of a year are read once for the co-reporting columns
+    co_reporting_graphs = CoReportingGraphs()
     offset = 0
     for index in range(0, bulks):
         start_index = index * bulk_size
@@ -226,6 +304,7 @@ def surveys_to_excel_workbook(survey_ids, include_previous_year=False):
             surveys,
             worksheet,
             headers_dict,
+            co_reporting_graphs,
             offset=offset,
             include_previous_year=include_previous_year
         )
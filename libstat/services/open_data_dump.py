@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+from libstat.models import OpenData, Artifact, Generation
+from libstat.services.artifact_store import store_artifact
+
+
+logger = logging.getLogger(__name__)
+
+DUMP_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+DUMP_FIELDS = ("variable_key", "sigel", "library_name", "target_group", "value")
+# The dump query in sigel order, also for the public Excel export
+DUMP_INDEX = [("is_active", 1), ("sample_year", 1), ("sigel", 1)]
+
+
+def dump_kind(dump_format):
+    return u"open_data_dump.{}".format(dump_format)
+
+
+def has_open_data(year):
+    return OpenData._get_collection().find_one({"is_active": True, "sample_year": year}, {"_id": 1}) is not None
+
+
+def dump_rows(year):
+    """
+        All active open data of the sample year as raw dicts with the DUMP_FIELDS, in DUMP_INDEX order.
+    """
+    projection = dict((field, 1) for field in DUMP_FIELDS)
+    projection["_id"] = 0
+    return OpenData._get_collection().find({"is_active": True, "sample_year": year}, projection).hint(DUMP_INDEX)
+
+
+def _encoded(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _write_ndjson(rows, out):
+    for row in rows:
+        out.write(json.dumps(dict((field, row.get(field)) for field in DUMP_FIELDS)))
+        out.write("\n")
+
+
+def _write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(DUMP_FIELDS)
+    for row in rows:
+        writer.writerow([_encoded(row.get(field)) for field in DUMP_FIELDS])
+
+
+def write_dump(year, dump_format):
+    """
+        Writes the gzipped dump of a sample year for the current open data generation of the year to a
+        temporary file and stores it as the current artifact of its kind and year. Returns the Artifact.
+    """
+    generation = Generation.current(OpenData.year_generation(year))
+    f, path = tempfile.mkstemp(suffix=".gz")
+    try:
+        with os.fdopen(f, "wb") as out_file:
+            # A fixed mtime gives the same bytes, and checksum, for the same data
+            out = gzip.GzipFile(filename="", mode="wb", fileobj=out_file, mtime=0)
+            try:
+                {"ndjson": _write_ndjson, "csv": _write_csv}[dump_format](dump_rows(year), out)
+            finally:
+                out.close()
+        return store_artifact(dump_kind(dump_format), year, generation, path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_dumps(year):
+    return [write_dump(year, dump_format) for dump_format in sorted(DUMP_FORMATS)]
+
+
+def dump_artifact(year, dump_format):
+    """
+        The gzipped dump of a sample year, written first if the open data of the year has changed since.
+    """
+    artifact = Artifact.current(dump_kind(dump_format), year)
+    if artifact and artifact.generation == Generation.current(OpenData.year_generation(year)):
+        return artifact
+    return write_dump(year, dump_format)
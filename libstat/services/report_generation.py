@@ -1,56 +1,284 @@
 # -*- coding: utf-8 -*-
 from pprint import pprint
-import uuid, logging
+import uuid, logging, hashlib, threading, time
+from collections import OrderedDict
+from datetime import datetime
 
-from libstat.models import Survey, Variable, OpenData, CachedReport
-from libstat.report_templates import report_template_base, report_template_base_with_municipality_calculations, report_template_base_with_target_group_calculations
+from django.conf import settings
+
+from data.principals import principal_for_library_type
+from libstat.models import (Survey, OpenData, CachedReport, Generation, NationalTotal, StatisticsCell,
+                            ReportLease, variable_registry)
+from libstat.report_templates import compiled_report_template
 
 
 logger = logging.getLogger(__name__)
 
 REPORT_CACHE_LIMIT = 500
+# Upper bound on the reports removed by a single store, keeps the sweep cheap when the limit is lowered
+REPORT_CACHE_EVICTION_BATCH = 50
+# A report computation holds a lease for at most this long, requests for the same report wait at most
+# REPORT_LEASE_WAIT_SECONDS for it before computing the report themselves
+REPORT_LEASE_SECONDS = 300
+REPORT_LEASE_WAIT_SECONDS = 60
+REPORT_LEASE_POLL_INTERVAL = 0.5
+# Cache hits and misses are added to the shared counters at most this often per process
+REPORT_CACHE_COUNTS_FLUSH_SECONDS = 60
 
-def get_cached_report(surveys, year):
-    if (CachedReport.objects.count() != 0 and
-            ((OpenData.objects.count() != 0
-              and OpenData.objects.first().date_modified > CachedReport.objects.first().date_created) or
-                 (Variable.objects.count() != 0 and Variable.objects.all().order_by("-date_modified").first().date_modified > CachedReport.objects.first().date_created))):
-        CachedReport.drop_collection()
 
-    reports = CachedReport.objects.filter(surveys__all=surveys, surveys__size=len(surveys), year=str(year))
-    report = reports[0].report if reports.count() == 1 else None
+def report_template_kind(surveys):
+    return template_kind_for_library_types([survey.library.library_type for survey in surveys])
 
-    return report
 
+def template_kind_for_library_types(library_types):
+    only_folkbib = all(libtype == u"folkbib" for libtype in library_types)
+
+    # This should of course be updated when (and if) more report templates are added
+
+    # Different report templates are used depending on types of libraries included
+    if only_folkbib:
+        return u"municipality"
+    elif len(library_types) > 1 and any(libtype == u"folkbib" for libtype in library_types):
+        return u"base"
+    else:
+        return u"target_group"
+
+
+def report_surveys(sample_year, sigels):
+    """
+        The published surveys a report of the libraries with the sigels covers, as chosen on the reports page.
+    """
+    return Survey.objects.filter(_status=u"published", sample_year=sample_year, library__sigel__in=sigels)
+
+
+def report_cache_key(surveys, year, template_kind):
+    return report_cache_key_for_ids([survey.pk for survey in surveys], year, template_kind)
+
+
+def report_cache_key_for_ids(survey_ids, year, template_kind):
+    survey_ids = sorted(unicode(survey_id) for survey_id in survey_ids)
+    return hashlib.sha1(u"{}|{}|{}".format(year, template_kind, u",".join(survey_ids)).encode("utf-8")).hexdigest()
+
+
+def report_dependencies(surveys, lineages):
+    """
+        Everything a report's observations were read from: the ids of the surveys and their predecessors,
+        and the library keys of each predecessor lookup, so that publishing a survey that would now be
+        found as a predecessor also invalidates the report.
+    """
+    dependencies = set()
+    for survey, lineage in zip(surveys, lineages):
+        chain = [survey] + lineage
+        dependencies.update(unicode(s.pk) for s in chain)
+        for s in chain[:2]:
+            dependencies.update(Survey.library_keys(s.sample_year - 1, s.library.sigel, s.library.name))
+    return sorted(dependencies)
+
+
+def report_cache_statistics():
+    report_cache_counts.flush()
+    return CachedReport.statistics()
+
+
+class ReportMemoryCache(object):
+    """
+        Bounded per process LRU of report dicts in front of CachedReport. Each entry is stored with the
+        token (open data and variables generations) it was valid for and is only served while the current
+        token is the same. Any publish therefore sends the next request for each report to CachedReport,
+        which knows which reports the publish actually affected.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, token):
+        with self._lock:
+            entry = self._reports.pop(key, None)
+            if entry is None or entry[0] != token:
+                self.misses += 1
+                return None
+            self._reports[key] = entry
+            self.hits += 1
+            # Callers add their own keys to the report
+            return dict(entry[1])
+
+    def put(self, key, token, report):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._reports.pop(key, None)
+            self._reports[key] = (token, dict(report))
+            while len(self._reports) > self.size:
+                self._reports.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._reports.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def statistics(self):
+        return {
+            u"size": len(self._reports),
+            u"max_size": self.size,
+            u"hits": self.hits,
+            u"misses": self.misses
+        }
+
+
+report_memory_cache = ReportMemoryCache(getattr(settings, "REPORT_MEMORY_CACHE_SIZE", 100))
+
+
+class ReportCacheCounts(object):
+    """
+        Per process counts of CachedReport hits and misses, added to the shared Generation counters at most
+        every 'flush_seconds' instead of writing to the database on every report lookup.
+    """
+
+    def __init__(self, flush_seconds):
+        self.flush_seconds = flush_seconds
+        self._counts = {}
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        counts, self._counts, self._flushed_at = self._counts, {}, time.time()
+        return counts
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            if time.time() - self._flushed_at < self.flush_seconds:
+                return
+            counts = self._take()
+        self._write(counts)
+
+    def flush(self):
+        with self._lock:
+            counts = self._take()
+        self._write(counts)
+
+    def clear(self):
+        with self._lock:
+            self._take()
+
+    def _write(self, counts):
+        for name, amount in counts.iteritems():
+            Generation.bump(name, amount)
+
+
+report_cache_counts = ReportCacheCounts(REPORT_CACHE_COUNTS_FLUSH_SECONDS)
+
+
+def report_cache_token():
+    return Generation.current(OpenData.GENERATION), variable_registry.generation
+
+
+def get_cached_report(key):
+    """
+        Returns (report, is_stale), or (None, False) when nothing is cached. Stale reports are only kept in
+        stale-while-revalidate mode.
+    """
+    cached_report = CachedReport.objects.filter(key=key).exclude("surveys", "dependencies").first()
+    if cached_report is None:
+        return None, False
+
+    variables_generation = variable_registry.generation
+    if cached_report.variables_generation != variables_generation:
+        # Variable descriptions are part of every report
+        CachedReport.evict(variables_generation__ne=variables_generation)
+        return cached_report.report, True
 
-def store_cached_report(report, surveys, year):
-    if not get_cached_report(surveys, year):
-        cached_report = CachedReport(report=report, surveys=surveys, year=str(year))
-        cached_report.save()
-    CachedReport.objects[REPORT_CACHE_LIMIT:].filter().delete()
+    CachedReport.objects.filter(key=key).update_one(set__last_accessed=datetime.utcnow())
+    return cached_report.report, cached_report.is_stale
+
+
+def wait_for_cached_report(key):
+    """
+        Waits for the holder of the report's lease to store it. Returns None if it is not stored in time or the
+        lease is released without storing it.
+    """
+    deadline = time.time() + REPORT_LEASE_WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(REPORT_LEASE_POLL_INTERVAL)
+        report, is_stale = get_cached_report(key)
+        if report is not None and not is_stale:
+            return report
+        if not ReportLease.is_held(key):
+            break
+    return None
+
+
+def store_cached_report(report, key, template_kind, surveys, year, dependencies, data_generation,
+                        variables_generation):
+    now = datetime.utcnow()
+    CachedReport.objects.filter(key=key).update_one(
+        upsert=True, set__template=template_kind, set__report=report, set__surveys=surveys, set__year=year,
+        set__dependencies=dependencies, set__data_generation=data_generation,
+        set__variables_generation=variables_generation, set__is_stale=False, set__date_created=now,
+        set__last_accessed=now)
+    CachedReport.evict_least_recently_used(REPORT_CACHE_LIMIT, REPORT_CACHE_EVICTION_BATCH)
 
 
 def get_report(surveys, year):
-    cached_report = get_cached_report(surveys, year)
+    template_kind = report_template_kind(surveys)
+    key = report_cache_key(surveys, year, template_kind)
 
-    if cached_report:
-        return cached_report
-    else:
+    # Read before looking anything up, a publish in between then only makes the entries look stale
+    token = report_cache_token()
 
-        library_types = [survey.library.library_type for survey in surveys]
-        only_folkbib = all(libtype == u"folkbib" for libtype in library_types)
+    report = report_memory_cache.get(key, token)
+    if report:
+        return report
 
-        # This should of course be updated when (and if) more report templates are added
+    cached_report, is_stale = get_cached_report(key)
 
-        # Different report templates are used depending on types of libraries included
-        if only_folkbib:
-            report_template = report_template_base_with_municipality_calculations()
-        elif len(surveys) > 1 and any(libtype == u"folkbib" for libtype in library_types):
-            report_template = report_template_base()
-        else:
-            report_template = report_template_base_with_target_group_calculations()
+    if cached_report and not is_stale:
+        report_cache_counts.count(CachedReport.HITS)
+        report_memory_cache.put(key, token, cached_report)
+        return cached_report
 
-        observations = pre_cache_observations(report_template, surveys, year)
+    report_cache_counts.count(CachedReport.MISSES)
+    stale_report = cached_report if is_stale and getattr(settings, "REPORT_STALE_WHILE_REVALIDATE", False) else None
+
+    # Only one process computes a report at a time, the others serve the stale report or wait for it
+    owner = ReportLease.acquire(key, REPORT_LEASE_SECONDS)
+    if owner is None:
+        if stale_report:
+            return stale_report
+        report = wait_for_cached_report(key)
+        if report:
+            return report
+    elif stale_report:
+        computation = threading.Thread(target=build_report, args=(surveys, year, template_kind, key, token, owner))
+        computation.daemon = True
+        computation.start()
+        return stale_report
+
+    return build_report(surveys, year, template_kind, key, token, owner)
+
+
+def build_report(surveys, year, template_kind, key, token, lease_owner=None):
+    """
+        Computes and caches a report, then releases the report's lease if 'lease_owner' holds it.
+    """
+    data_generation, variables_generation = token
+    try:
+        library_types = [survey.library.library_type for survey in surveys]
+        report_template = compiled_report_template(template_kind)
+
+        lineages = Survey.previous_years_surveys(surveys, years=2)
+        dependencies = report_dependencies(surveys, lineages)
+        selection = standard_selection(surveys, year)
+        if selection:
+            observations = cube_observations(report_template, year, lineages, *selection)
+            dependencies.append(StatisticsCell.selection_key(year, *selection))
+        else:
+            observations = pre_cache_observations(report_template, surveys, year, lineages=lineages)
 
         sigels = [sigel for survey in surveys for sigel in survey.selected_libraries]
         libraries = [survey.library for survey in Survey.objects.filter(sample_year=year, library__sigel__in=sigels)]
@@ -73,13 +301,20 @@ def get_report(surveys, year):
             "measurements": generate_report(report_template, year, observations, library_types)
         }
 
-        store_cached_report(report, surveys, year)
+        # A publish during the computation makes the result unsafe to store
+        if Generation.current(OpenData.GENERATION) == data_generation:
+            store_cached_report(report, key, template_kind, surveys, year, dependencies, data_generation,
+                                variables_generation)
+            report_memory_cache.put(key, token, report)
 
         return report
+    finally:
+        if lease_owner:
+            ReportLease.release(key, lease_owner)
 
 
 def is_variable_to_be_included(variable_key, library_types):
-    variable = Variable.objects.filter(key=variable_key).first()
+    variable = variable_registry.get(variable_key)
     if variable and variable.target_groups and len(variable.target_groups) > 0 and \
                 any([library_type not in variable.target_groups for library_type in library_types]):
         return False
@@ -180,83 +415,175 @@ def generate_report(report_template, year, observations, library_types):
     return report
 
 
-def pre_cache_observations(template, surveys, year):
-    def is_number(obj):
-        return isinstance(obj, (int, long, float, complex))
-
+def variables_for_keys(template):
+    variables_for_key = {}
+    for variable in filter(None, [variable_registry.get(key) for key in template.all_variable_keys]):
+        variables = [variable]
+        if len(variable.replaces) > 0:
+            library_types = [target_group for replaced in variable.replaces for target_group in replaced.target_groups]
+            if len(library_types) == len(set(library_types)):
+                variables += variable.replaces
+        variables_for_key[variable.key] = variables
+    return variables_for_key
+
+
+def observation_skeleton(year, total):
+    return {
+        year: None,
+        (year - 1): None,
+        (year - 2): None,
+        "incomplete_data": [],
+        "total": total
+    }
+
+
+def standard_selection(surveys, year):
+    """
+        Returns (area, principal) when the surveys are all published surveys of a municipality or county
+        (area), of a principal, of both or of the whole country (area and principal None), otherwise None.
+        Those are the selections the reports page offers and the statistics cube can answer.
+    """
+    if not surveys or any(not survey.is_published or survey.sample_year != year for survey in surveys):
+        return None
+
+    municipality_codes = set(survey.library.municipality_code for survey in surveys)
+    counties = set(StatisticsCell.county_for(code) for code in municipality_codes)
+    principals = set(principal_for_library_type.get(survey.library.library_type) for survey in surveys)
+
+    areas = [None]
+    if len(counties) == 1 and None not in counties:
+        areas.insert(0, list(counties)[0])
+        if len(municipality_codes) == 1:
+            areas.insert(0, list(municipality_codes)[0])
+    candidate_principals = [None]
+    if len(principals) == 1 and None not in principals:
+        candidate_principals.insert(0, list(principals)[0])
+
+    # The cells counting surveys, at most one per municipality and library type
+    survey_cells = StatisticsCell.objects.filter(sample_year=year, variable_key=None)
+    if areas[0] is not None:
+        survey_cells = survey_cells.filter(county=list(counties)[0])
+    survey_cells = list(survey_cells.only("municipality_code", "county", "principal", "count").as_pymongo())
+
+    for area in areas:
+        for principal in candidate_principals:
+            query = StatisticsCell.selection_query(area, principal)
+            if sum(cell["count"] for cell in survey_cells
+                   if all(cell.get(field) == value for field, value in query.iteritems())) == len(surveys):
+                return area, principal
+    return None
+
+
+def cube_observations(template, year, lineages, area=None, principal=None):
+    """
+        Same as 'pre_cache_observations' for a standard selection (see 'standard_selection'). The sample year
+        is read from the statistics cube, the previous years from the open data of the surveys' predecessors
+        ('lineages', see Survey.previous_years_surveys), as the libraries of a selection change between years.
+    """
+    survey_ids = {
+        year: [],
+        (year - 1): [],
+        (year - 2): []
+    }
+    for lineage in lineages:
+        for years_back, survey in enumerate(lineage, start=1):
+            survey_ids[year - years_back].append(survey.pk)
+    observations = open_data_observations(template, survey_ids, year)
+
+    variables_for_key = variables_for_keys(template)
+    variable_keys = set(variable.key for variables in variables_for_key.values() for variable in variables)
+    totals = StatisticsCell.objects.filter(sample_year=year, variable_key__in=[None] + list(variable_keys),
+                                           **StatisticsCell.selection_query(area, principal)
+                                           ).totals_by_variable_and_year()
+    number_of_surveys = totals.get((None, year), (0, 0, 0))[1]
+
+    for key, variables in variables_for_key.iteritems():
+        cells = [totals.get((variable.key, year), (0, 0, 0)) for variable in variables]
+        sum_value = sum(cell[0] for cell in cells)
+        count = sum(cell[1] for cell in cells)
+
+        if any(cell[2] for cell in cells) or count < number_of_surveys:
+            observations[key]["incomplete_data"].insert(0, year)
+
+        if sum_value and count != 0:
+            observations[key][year] = float(sum_value)
+
+    return observations
+
+
+def pre_cache_observations(template, surveys, year, lineages=None):
     def survey_ids_three_latest_years():
         survey_ids = {
-            year: [],
+            year: [survey.pk for survey in surveys],
             (year - 1): [],
             (year - 2): []
         }
 
-        for survey in surveys:
-            survey_ids[year].append(survey.pk)
-            previous_survey = survey.previous_years_survey()
-            if previous_survey:
-                survey_ids[year - 1].append(previous_survey.pk)
-                previous_previous_survey = previous_survey.previous_years_survey()
-                if previous_previous_survey:
-                    survey_ids[year - 2].append(previous_previous_survey.pk)
+        for lineage in lineages if lineages is not None else Survey.previous_years_surveys(surveys, years=2):
+            for years_back, survey in enumerate(lineage, start=1):
+                survey_ids[year - years_back].append(survey.pk)
         return survey_ids
 
-    def observation_skeleton(variables):
-        try:
-            total = float(OpenData.objects.filter(sample_year=year, is_active=True, variable__in=variables).sum("value"))
-        except Exception as e:
-            total = None
-        returns = {
-            year: None,
-            (year - 1): None,
-            (year - 2): None,
-            "incomplete_data": [],
-            "total": total
-        }
-        return returns
-
-    survey_ids = survey_ids_three_latest_years()
+    return open_data_observations(template, survey_ids_three_latest_years(), year)
+
+
+def open_data_observations(template, survey_ids, year):
+    """
+        Sums the open data of the surveys in 'survey_ids' ({sample year: survey ids}) per key of the template
+        and year.
+    """
+    years = (year, year - 1, year - 2)
+
+    variables_for_key = variables_for_keys(template)
+
+    keys_for_variable = {}
+    for key, variables in variables_for_key.iteritems():
+        for variable in variables:
+            keys_for_variable.setdefault(variable.id, []).append(key)
+    variable_ids = keys_for_variable.keys()
+
+    national_totals = NationalTotal.totals(year, set(variable.key for variables in variables_for_key.values()
+                                                     for variable in variables))
+
+    # Two server side aggregations replace the per key and year queries: sums and counts for
+    # the selected surveys, and the few values not stored as numbers.
+    open_data = OpenData.objects.filter(source_survey__in=[pk for y in years for pk in survey_ids[y]],
+                                        variable__in=variable_ids, is_active=True)
+    sums = open_data.sums_by_variable_and_year()
+
+    sum_values = {}
+    counts = {}
+    unparsable = set()
+    for (variable_id, y), (sum_value, count) in sums.iteritems():
+        for key in keys_for_variable.get(variable_id, []):
+            sum_values[(key, y)] = sum_values.get((key, y), 0) + sum_value
+            counts[(key, y)] = counts.get((key, y), 0) + count
+
+    for od in open_data.non_numeric_values():
+        for key in keys_for_variable.get(od["variable"], []):
+            try:
+                sum_values[(key, od["sample_year"])] = sum_values.get((key, od["sample_year"]), 0) + float(od.get("value"))
+            except (TypeError, ValueError):
+                # Value is missing or empty
+                # Note: this should not happen, as open_data objects are only created from observations w values, and deleted if observation value is emptied
+                unparsable.add((key, od["sample_year"]))
 
     observations = {}
-    for key in template.all_variable_keys:
-        variables = Variable.objects.filter(key=key)
-        if variables.count() != 1:
-            continue
-        variables = [variables[0]]
-
-        if len(variables[0].replaces) > 0:
-            library_types = [target_group for variable in variables[0].replaces for target_group in variable.target_groups]
-            if len(library_types) == len(set(library_types)):
-                    variables += variables[0].replaces
-
-        observations[key] = observation_skeleton(variables)
-
-        for y in (year, year - 1, year - 2):
-            open_data = OpenData.objects.filter(source_survey__in=survey_ids[y], variable__in=variables,
-                                                is_active=True)
-            sum_value = 0
-            for od in open_data:
-                try:
-                    if is_number(od.value):
-                        sum_value += od.value
-                    else:
-                        sum_value += float(od.value)
-                except:
-                    # Value is missing or empty
-                    # Note: this should not happen, as open_data objects are only created from observations w values, and deleted if observation value is emptied
-                    observations[key]["incomplete_data"].append(y)
-                    continue
-
-            if sum_value == 0:
-                sum_value = None
-
-            if sum_value and open_data.count() != 0:
-                try:
-                    observations[key][y] = float(sum_value)
-                except:
-                    observations[key][y] = None
-
-            if open_data.count() < len(survey_ids[y]) and y not in observations[key]["incomplete_data"]:
+    for key, variables in variables_for_key.iteritems():
+        total = sum(national_totals.get(variable.key, 0) for variable in variables)
+        observations[key] = observation_skeleton(year, float(total))
+
+        for y in years:
+            sum_value = sum_values.get((key, y), 0)
+            count = counts.get((key, y), 0)
+
+            if (key, y) in unparsable:
+                observations[key]["incomplete_data"].append(y)
+
+            if sum_value and count != 0:
+                observations[key][y] = float(sum_value)
+
+            if count < len(survey_ids[y]) and y not in observations[key]["incomplete_data"]:
                 observations[key]["incomplete_data"].append(y)
 
-    return observations
\ No newline at end of file
+    return observations
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from mongoengine.connection import connect, disconnect
+
+from data.municipalities import get_counties, municipalities
+from data.principals import library_types_for_principal
+from libstat.models import Survey, OpenData, Generation, variable_registry
+from libstat.services.batch_report_generation import ReportBatch
+from libstat.services.report_generation import report_cache_key_for_ids, store_cached_report, report_surveys
+
+
+logger = logging.getLogger(__name__)
+
+
+def standard_selections(year):
+    """
+        The (area, principal) selections offered on the reports page without unchecking any library: each
+        municipality, each county, each principal and the whole country.
+    """
+    surveys = Survey.objects.filter(_status=u"published", sample_year=year)
+    municipality_codes = [(municipalities[code], code) for code in surveys.distinct("library.municipality_code")
+                          if code in municipalities]
+    library_types = set(surveys.distinct("library.library_type"))
+    if not library_types:
+        return []
+
+    selections = [(code, None) for name, code in sorted(municipality_codes)]
+    selections += [(code, None) for name, code in sorted(get_counties(municipality_codes))]
+    selections += [(None, principal) for principal, types in sorted(library_types_for_principal.items())
+                   if library_types.intersection(types)]
+    selections.append((None, None))
+    return selections
+
+
+def _reconnect():
+    # Connections opened before forking must not be shared with the parent process
+    disconnect()
+    connect(settings.MONGODB_NAME, host=settings.MONGODB_DATABASE_HOST)
+
+
+def generate_selections(year, selections):
+    """
+        Generates and caches the reports of the selections with one ReportBatch. Returns (selection, number of
+        surveys, seconds) per stored report, where seconds is the report's share of the batch plus storing it.
+        Reports are stored under the key of the surveys the report view reads when all libraries of the
+        selection are chosen, and not at all when those differ from the selection's surveys. Nothing is
+        stored when open data of the year is published during the computation.
+    """
+    data_generation = Generation.current(OpenData.GENERATION)
+    variables_generation = variable_registry.generation
+
+    started = time.time()
+    batch = ReportBatch(year)
+    reports = batch.generate(selections)
+    batch_seconds = (time.time() - started) / max(len(reports), 1)
+
+    timings = []
+    for selection, report in reports.iteritems():
+        if Generation.current(OpenData.GENERATION) != data_generation:
+            logger.info(u"Open data was published while generating reports for {}, stopping".format(year))
+            break
+
+        stored = time.time()
+        survey_ids = [survey.pk for survey in report_surveys(year, batch.sigels_for(selection)).only("id")]
+        if sorted(survey_ids) != sorted(batch.survey_ids_for(selection)):
+            logger.info(u"The report view reads other surveys than the selection {} of {}, not storing it".format(
+                selection, year))
+            continue
+        template_kind = batch.template_kind(selection)
+        store_cached_report(report, report_cache_key_for_ids(survey_ids, year, template_kind), template_kind,
+                            survey_ids, year, batch.dependencies_for(selection), data_generation,
+                            variables_generation)
+        timings.append((selection, len(survey_ids), batch_seconds + time.time() - stored))
+    return timings
+
+
+def _generate_chunk(arguments):
+    return generate_selections(*arguments)
+
+
+def pregenerate_reports(year, processes=1, progress=None):
+    """
+        Generates and caches the reports of all standard selections of a sample year, split over a pool of
+        'processes' worker processes. 'progress' is called with (done, total, selection, number of surveys,
+        seconds) for each stored report. Returns the number of stored reports.
+    """
+    selections = standard_selections(year)
+    if not selections:
+        return 0
+
+    chunks = [(year, selections[index::processes]) for index in range(min(processes, len(selections)))]
+    if processes > 1:
+        pool = Pool(processes, initializer=_reconnect)
+        try:
+            results = pool.imap_unordered(_generate_chunk, chunks)
+            done = _report_progress(results, len(selections), progress)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        done = _report_progress((_generate_chunk(chunk) for chunk in chunks), len(selections), progress)
+    return done
+
+
+def _report_progress(results, total, progress):
+    done = 0
+    for timings in results:
+        for selection, number_of_surveys, seconds in timings:
+            done += 1
+            if progress:
+                progress(done, total, selection, number_of_surveys, seconds)
+    return done
+
+
+def published_years_changed_since(generations):
+    """
+        Returns the sample years whose open data generation differs from the one in 'generations' (a dict
+        {sample_year: generation}) and updates it.
+    """
+    changed = []
+    for year in Survey.objects.filter(_status=u"published").distinct("sample_year"):
+        generation = Generation.current(OpenData.year_generation(year))
+        if generations.get(year) != generation:
+            generations[year] = generation
+            changed.append(year)
+    return sorted(changed)
@@ -11,7 +11,7 @@ from django.test import TestCase
 from django.conf import settings
 from django.core.urlresolvers import reverse
 
-from libstat.models import Variable, OpenData, Survey, Library, SurveyObservation, Article, Dispatch, ExternalIdentifier
+from libstat.models import Variable, OpenData, Survey, Library, SurveyObservation, Article, Dispatch, ExternalIdentifier, variable_registry
 
 
 class MongoEngineTestRunner(DiscoverRunner):
@@ -137,6 +137,7 @@ class MongoTestCase(TestCase):
             MongoUser.objects.create_superuser("admin", "admin@example.com", "admin")
         if MongoUser.objects.filter(username="library_user").count() == 0:
             MongoUser.objects.create_user("library_user", "library.user@example.com", "secret")
+        variable_registry.invalidate()
         setup_test_environment()
 
     def _post_teardown(self):
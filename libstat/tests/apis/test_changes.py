@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+import json
+
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+
+from libstat.tests import MongoTestCase
+from libstat.models import OpenData
+
+
+@override_settings(OPEN_DATA_CHANGES_DELAY_SECONDS=0)
+class ChangesApiTest(MongoTestCase):
+
+    def _changes(self, next_link=u""):
+        return json.loads(self.client.get(u"{}{}".format(reverse("changes_api"), next_link)).content)
+
+    def test_should_return_upserts_of_published_survey(self):
+        variable = self._dummy_variable(key=u"folk5")
+        self._dummy_survey(publish=True, observations=[self._dummy_observation(variable=variable, value=3)])
+        open_data = OpenData.objects.get(variable=variable)
+
+        data = self._changes()
+
+        self.assertEquals([(change[u"change"], change[u"@id"]) for change in data[u"changes"]],
+                          [(u"upsert", str(open_data.id))])
+        self.assertEquals(data[u"changes"][0][u"observation"][u"folk5"], 3)
+
+    def test_should_return_tombstones_after_unpublishing(self):
+        variable = self._dummy_variable(key=u"folk5")
+        survey = self._dummy_survey(publish=True, observations=[self._dummy_observation(variable=variable, value=3)])
+        open_data = OpenData.objects.get(variable=variable)
+        next_link = self._changes()[u"next"]
+
+        survey.unpublish()
+        data = self._changes(next_link)
+
+        self.assertEquals(data[u"changes"], [{u"@id": str(open_data.id), u"change": u"delete"}])
+
+    def test_should_return_tombstones_for_deleted_values(self):
+        variable = self._dummy_variable(key=u"folk5")
+        survey = self._dummy_survey(publish=True, observations=[self._dummy_observation(variable=variable, value=3)])
+        open_data = OpenData.objects.get(variable=variable)
+        next_link = self._changes()[u"next"]
+
+        survey.observations[0].value = u""
+        survey.publish()
+        data = self._changes(next_link)
+
+        self.assertEquals(data[u"changes"], [{u"@id": str(open_data.id), u"change": u"delete"}])
+
+    def test_should_page_changes_in_order(self):
+        surveys = [self._dummy_survey(publish=True, observations=[self._dummy_observation(value=value)])
+                   for value in range(3)]
+        ids = [str(OpenData.objects.get(source_survey=survey.pk).id) for survey in surveys]
+
+        seen = []
+        next_link = u"?limit=2"
+        while True:
+            data = self._changes(next_link)
+            if not data[u"changes"]:
+                break
+            seen += [change[u"@id"] for change in data[u"changes"]]
+            next_link = data[u"next"]
+
+        self.assertEquals(seen, ids)
+
+    def test_should_return_bad_request_for_invalid_since_token(self):
+        response = self.client.get(u"{}?since=invalid".format(reverse("changes_api")))
+
+        self.assertEquals(response.status_code, 400)
@@ -1,12 +1,17 @@
 # -*- coding: UTF-8 -*-
+import gzip
 import json
 from datetime import datetime
+from StringIO import StringIO
 
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.test.utils import override_settings
+from django.utils.http import http_date
 
 from libstat.tests import MongoTestCase
-from libstat.apis.open_data import data_context
+from libstat.models import OpenData, Generation
+from libstat.apis.open_data import data_context, DATA_API_STREAMING_LIMIT
 
 
 class OpenDataApiTest(MongoTestCase):
@@ -105,3 +110,197 @@ class OpenDataApiTest(MongoTestCase):
         response = self._get_json("data_api")
 
         self.assertEquals(len(response[u"observations"]), 1)
+
+    def test_should_page_with_after_token_from_next(self):
+        same_date = datetime(2014, 06, 02, 17, 57, 16)
+        ids = set(str(self._dummy_open_data(date_modified=same_date).id) for _ in range(3))
+        ids.add(str(self._dummy_open_data(date_modified=datetime(2014, 06, 03)).id))
+
+        seen = []
+        url = u"{}?limit=2".format(reverse("data_api"))
+        while url:
+            data = json.loads(self.client.get(url).content)
+            seen += [observation[u"@id"] for observation in data[u"observations"]]
+            url = u"{}{}".format(reverse("data_api"), data[u"next"]) if u"next" in data else None
+
+        self.assertEquals(len(seen), 4)
+        self.assertEquals(set(seen), ids)
+
+    def test_should_keep_term_in_next(self):
+        variable = self._dummy_variable(key=u"folk6")
+        self._dummy_open_data(variable=variable)
+        self._dummy_open_data(variable=variable)
+        self._dummy_open_data()
+
+        data = json.loads(self.client.get(u"{}?term=folk6&limit=1".format(reverse("data_api"))).content)
+        data = json.loads(self.client.get(u"{}{}".format(reverse("data_api"), data[u"next"])).content)
+
+        self.assertEquals(len(data[u"observations"]), 1)
+        self.assertEquals(data[u"observations"][0][u"folk6"], 1)
+
+    def test_should_return_bad_request_for_invalid_after_token(self):
+        response = self.client.get(u"{}?after=invalid".format(reverse("data_api")))
+
+        self.assertEquals(response.status_code, 400)
+
+    def test_should_stream_large_pages(self):
+        for _ in range(3):
+            self._dummy_open_data()
+
+        response = self.client.get(u"{}?limit={}".format(reverse("data_api"), DATA_API_STREAMING_LIMIT + 1))
+        data = json.loads("".join(response.streaming_content))
+
+        self.assertTrue(response.streaming)
+        self.assertEquals(len(data[u"observations"]), 3)
+        self.assertEquals(data[u"@context"], json.loads(self.client.get(reverse("data_api")).content)[u"@context"])
+        self.assertFalse(u"next" in data)
+
+    @override_settings(ARTIFACT_STORE="gridfs")
+    def test_should_return_gzipped_dump_of_year(self):
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk1"), sample_year=2014)
+
+        response = self.client.get(reverse("dump_api", kwargs={"year": "2014", "dump_format": "ndjson"}),
+                                   HTTP_ACCEPT_ENCODING="gzip")
+        rows = [json.loads(line) for line in
+                gzip.GzipFile(fileobj=StringIO("".join(response.streaming_content))).read().splitlines()]
+
+        self.assertEquals(response["Content-Encoding"], "gzip")
+        self.assertEquals([row[u"variable_key"] for row in rows], [u"folk1"])
+
+    def test_should_return_decompressed_dump_when_gzip_is_refused(self):
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk1"), sample_year=2014)
+
+        response = self.client.get(reverse("dump_api", kwargs={"year": "2014", "dump_format": "ndjson"}),
+                                   HTTP_ACCEPT_ENCODING="gzip;q=0, x-gzip, identity")
+        rows = [json.loads(line) for line in "".join(response.streaming_content).splitlines()]
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEquals([row[u"variable_key"] for row in rows], [u"folk1"])
+
+    def test_should_return_byte_range_of_gzipped_dump(self):
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk1"), sample_year=2014)
+        url = reverse("dump_api", kwargs={"year": "2014", "dump_format": "csv"})
+        full = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        content = "".join(full.streaming_content)
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_RANGE="bytes=10-")
+
+        self.assertEquals(full["Content-Length"], str(len(content)))
+        self.assertEquals(full["Accept-Ranges"], "bytes")
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response["Content-Range"], "bytes 10-{}/{}".format(len(content) - 1, len(content)))
+        self.assertEquals("".join(response.streaming_content), content[10:])
+
+    def test_should_return_full_dump_when_if_range_does_not_match(self):
+        self._dummy_open_data(sample_year=2014)
+        url = reverse("dump_api", kwargs={"year": "2014", "dump_format": "csv"})
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"')
+
+        self.assertEquals(response.status_code, 200)
+
+    def test_should_not_satisfy_range_beyond_dump(self):
+        self._dummy_open_data(sample_year=2014)
+        url = reverse("dump_api", kwargs={"year": "2014", "dump_format": "csv"})
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip", HTTP_RANGE="bytes=100000-")
+
+        self.assertEquals(response.status_code, 416)
+
+    def test_should_return_not_modified_export_for_checksum_etag(self):
+        self._dummy_open_data(sample_year=2014)
+        url = u"{}?sample_year=2014".format(reverse("export_api"))
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(response.status_code, 304)
+
+    def test_should_return_not_found_for_dump_of_year_without_open_data(self):
+        response = self.client.get(reverse("dump_api", kwargs={"year": "2014", "dump_format": "csv"}))
+
+        self.assertEquals(response.status_code, 404)
+
+    def test_should_return_not_modified_for_current_etag(self):
+        self._dummy_open_data()
+        etag = self.client.get(reverse("data_api"))["ETag"]
+
+        response = self.client.get(reverse("data_api"), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(response.status_code, 304)
+
+    def test_should_return_data_when_open_data_is_modified_after_etag(self):
+        self._dummy_open_data()
+        etag = self.client.get(reverse("data_api"))["ETag"]
+        self._dummy_open_data(date_modified=datetime(2014, 06, 03))
+
+        response = self.client.get(reverse("data_api"), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json.loads(response.content)[u"observations"]), 2)
+
+    def test_should_return_open_data_deleted_since_if_modified_since(self):
+        self._dummy_open_data()
+        deleted = self._dummy_open_data()
+        self.assertFalse(self.client.get(reverse("data_api")).has_header("Last-Modified"))
+        deleted.delete()
+        Generation.bump(OpenData.GENERATION)
+
+        response = self.client.get(reverse("data_api"), HTTP_IF_MODIFIED_SINCE=http_date())
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json.loads(response.content)[u"observations"]), 1)
+
+    def test_should_use_query_parameters_in_etag(self):
+        self._dummy_open_data()
+        etag = self.client.get(reverse("data_api"))["ETag"]
+
+        response = self.client.get(u"{}?limit=1".format(reverse("data_api")), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(response.status_code, 200)
+
+    def test_should_filter_by_sample_year_and_target_group(self):
+        self._dummy_open_data(sample_year=2014, target_group="folkbib", value=1)
+        self._dummy_open_data(sample_year=2014, target_group="skolbib", value=2)
+        self._dummy_open_data(sample_year=2013, target_group="folkbib", value=3)
+
+        data = json.loads(self.client.get(u"{}?sample_year=2014&target_group=folkbib".format(
+            reverse("data_api"))).content)
+
+        self.assertEquals([observation[u"sampleYear"] for observation in data[u"observations"]], [2014])
+        self.assertEquals(data[u"observations"][0][u"targetGroup"], u"Folkbibliotek")
+
+    def test_should_filter_by_sigel(self):
+        self._dummy_open_data(sigel="sigel1")
+        self._dummy_open_data(sigel="sigel2")
+
+        data = json.loads(self.client.get(u"{}?sigel=sigel1".format(reverse("data_api"))).content)
+
+        self.assertEquals(len(data[u"observations"]), 1)
+        self.assertTrue(data[u"observations"][0][u"library"][u"@id"].endswith(u"/library/sigel1"))
+
+    def test_should_filter_by_multiple_terms(self):
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk6"))
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk7"))
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk8"))
+
+        data = json.loads(self.client.get(u"{}?term=folk6&term=folk7".format(reverse("data_api"))).content)
+        comma_data = json.loads(self.client.get(u"{}?term=folk6,folk7".format(reverse("data_api"))).content)
+
+        self.assertEquals(len(data[u"observations"]), 2)
+        self.assertEquals(len(comma_data[u"observations"]), 2)
+
+    def test_should_keep_filters_in_next(self):
+        for _ in range(2):
+            self._dummy_open_data(sample_year=2014)
+        self._dummy_open_data(sample_year=2013)
+
+        data = json.loads(self.client.get(u"{}?sample_year=2014&limit=1".format(reverse("data_api"))).content)
+        data = json.loads(self.client.get(u"{}{}".format(reverse("data_api"), data[u"next"])).content)
+
+        self.assertEquals([observation[u"sampleYear"] for observation in data[u"observations"]], [2014])
+
+    def test_should_refuse_target_group_without_indexed_filter(self):
+        response = self.client.get(u"{}?target_group=folkbib".format(reverse("data_api")))
+
+        self.assertEquals(response.status_code, 400)
@@ -50,4 +50,24 @@ class TermsApiTest(MongoTestCase):
 
         self.assertFalse(u"Folk69" in ids)
 
+    def test_should_return_not_modified_until_a_variable_is_saved(self):
+        variable = self._dummy_variable(key=u"folk5")
+        etag = self.client.get(reverse("terms_api"))["ETag"]
 
+        self.assertEquals(self.client.get(reverse("terms_api"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        variable.description = u"new description"
+        variable.save()
+
+        self.assertEquals(self.client.get(reverse("terms_api"), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_should_rebuild_vocabulary_when_a_variable_is_saved(self):
+        self._dummy_variable(key=u"folk5")
+        self.client.get(reverse("terms_api"))
+
+        self._dummy_variable(key=u"folk6")
+        data = json.loads(self.client.get(reverse("terms_api")).content)
+        ids = [term[u"@id"] for term in data[u"terms"]]
+
+        self.assertTrue(u"folk5" in ids)
+        self.assertTrue(u"folk6" in ids)
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import NationalTotal
+
+
+class TestNationalTotal(MongoTestCase):
+    def test_sums_published_values_per_variable_and_year(self):
+        variable1 = self._dummy_variable(key=u"key1")
+        variable2 = self._dummy_variable(key=u"key2")
+        self._dummy_survey(sample_year=2014, publish=True,
+                           observations=[self._dummy_observation(variable=variable1, value=3),
+                                         self._dummy_observation(variable=variable2, value=7)])
+        self._dummy_survey(sample_year=2014, publish=True,
+                           observations=[self._dummy_observation(variable=variable1, value=5)])
+        self._dummy_survey(sample_year=2013, publish=True,
+                           observations=[self._dummy_observation(variable=variable1, value=11)])
+
+        self.assertEqual(NationalTotal.totals(2014, [u"key1", u"key2"]), {u"key1": 8.0, u"key2": 7.0})
+        self.assertEqual(NationalTotal.totals(2013, [u"key1", u"key2"]), {u"key1": 11.0})
+
+    def test_updates_total_when_survey_is_republished(self):
+        variable = self._dummy_variable(key=u"key1")
+        survey = self._dummy_survey(sample_year=2014, publish=True,
+                                    observations=[self._dummy_observation(variable=variable, value=3)])
+
+        survey.observations[0].value = 4
+        survey.publish()
+
+        self.assertEqual(NationalTotal.totals(2014, [u"key1"]), {u"key1": 4.0})
+
+    def test_subtracts_values_of_unpublished_survey(self):
+        variable = self._dummy_variable(key=u"key1")
+        self._dummy_survey(sample_year=2014, publish=True,
+                           observations=[self._dummy_observation(variable=variable, value=3)])
+        survey = self._dummy_survey(sample_year=2014, publish=True,
+                                    observations=[self._dummy_observation(variable=variable, value=5)])
+
+        survey.unpublish()
+
+        self.assertEqual(NationalTotal.totals(2014, [u"key1"]), {u"key1": 3.0})
+
+    def test_rebuilds_totals_from_open_data(self):
+        variable = self._dummy_variable(key=u"key1")
+        self._dummy_survey(sample_year=2014, publish=True,
+                           observations=[self._dummy_observation(variable=variable, value=3)])
+        NationalTotal.objects.delete()
+
+        NationalTotal.rebuild()
+
+        self.assertEqual(NationalTotal.totals(2014, [u"key1"]), {u"key1": 3.0})
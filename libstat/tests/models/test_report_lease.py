@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+from datetime import datetime, timedelta
+
+from libstat.tests import MongoTestCase
+from libstat.models import ReportLease
+
+
+class TestReportLease(MongoTestCase):
+    def test_acquires_lease_not_held_by_anyone(self):
+        self.assertNotEqual(ReportLease.acquire(u"key", 60), None)
+        self.assertTrue(ReportLease.is_held(u"key"))
+
+    def test_does_not_acquire_lease_held_by_someone_else(self):
+        ReportLease.acquire(u"key", 60)
+
+        self.assertEqual(ReportLease.acquire(u"key", 60), None)
+
+    def test_acquires_released_lease(self):
+        owner = ReportLease.acquire(u"key", 60)
+        ReportLease.release(u"key", owner)
+
+        self.assertFalse(ReportLease.is_held(u"key"))
+        self.assertNotEqual(ReportLease.acquire(u"key", 60), None)
+
+    def test_acquires_expired_lease(self):
+        ReportLease.acquire(u"key", 60)
+        ReportLease.objects.filter(key=u"key").update_one(set__expires_at=datetime.utcnow() - timedelta(seconds=1))
+
+        self.assertNotEqual(ReportLease.acquire(u"key", 60), None)
+
+    def test_does_not_release_lease_of_someone_else(self):
+        ReportLease.acquire(u"key", 60)
+
+        ReportLease.release(u"key", u"someone_else")
+
+        self.assertTrue(ReportLease.is_held(u"key"))
@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import StatisticsCell
+
+
+class TestStatisticsCell(MongoTestCase):
+    def _totals(self, **query):
+        return StatisticsCell.objects.filter(**query).totals_by_variable_and_year()
+
+    def test_sums_published_values_per_partition(self):
+        variable = self._dummy_variable(key=u"key1")
+        self._dummy_survey(sample_year=2014, publish=True, library=self._dummy_library(municipality_code=u"0180"),
+                           observations=[self._dummy_observation(variable=variable, value=3)])
+        self._dummy_survey(sample_year=2014, publish=True, library=self._dummy_library(municipality_code=u"0180"),
+                           observations=[self._dummy_observation(variable=variable, value=u"not a number")])
+        self._dummy_survey(sample_year=2014, publish=True, library=self._dummy_library(municipality_code=u"0127"),
+                           observations=[self._dummy_observation(variable=variable, value=5)])
+
+        self.assertEqual(self._totals(municipality_code=u"0180"), {
+            (u"key1", 2014): (3.0, 2, 1),
+            (None, 2014): (0.0, 2, 0)
+        })
+        self.assertEqual(self._totals(county=u"0100", principal=u"kommun"), {
+            (u"key1", 2014): (8.0, 3, 1),
+            (None, 2014): (0.0, 3, 0)
+        })
+
+    def test_removes_values_of_unpublished_survey(self):
+        variable = self._dummy_variable(key=u"key1")
+        library = self._dummy_library(municipality_code=u"0180")
+        self._dummy_survey(sample_year=2014, publish=True, library=library,
+                           observations=[self._dummy_observation(variable=variable, value=3)])
+        survey = self._dummy_survey(sample_year=2014, publish=True, library=self._dummy_library(municipality_code=u"0180"),
+                                    observations=[self._dummy_observation(variable=variable, value=5)])
+
+        survey.status = u"not_viewed"
+        survey.save()
+
+        self.assertEqual(self._totals(municipality_code=u"0180"), {
+            (u"key1", 2014): (3.0, 1, 0),
+            (None, 2014): (0.0, 1, 0)
+        })
+
+    def test_rebuilds_cells_from_published_surveys(self):
+        variable = self._dummy_variable(key=u"key1")
+        self._dummy_survey(sample_year=2014, publish=True, library=self._dummy_library(municipality_code=u"0180"),
+                           observations=[self._dummy_observation(variable=variable, value=3)])
+        StatisticsCell.objects.delete()
+
+        self.assertEqual(StatisticsCell.rebuild(), 1)
+        self.assertEqual(self._totals(municipality_code=u"0180"), {
+            (u"key1", 2014): (3.0, 1, 0),
+            (None, 2014): (0.0, 1, 0)
+        })
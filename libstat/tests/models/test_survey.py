@@ -4,7 +4,7 @@ from sets import Set
 from data.principals import PRINCIPALS
 
 from libstat.tests import MongoTestCase
-from libstat.models import OpenData, Survey, SurveyVersion, SurveyEditingLock
+from libstat.models import OpenData, Survey, SurveyVersion, SurveyEditingLock, CoReportingGraph
 
 
 class TestSurveyModel(MongoTestCase):
@@ -903,6 +903,36 @@ class TestPreviousYearsSurvey(MongoTestCase):
 
         self.assertEqual(None, this_years_survey.previous_years_survey())
 
+    def test_resolves_previous_years_survey_ids_for_several_surveys_and_years(self):
+        library1 = self._dummy_library(sigel="lib1", name="lib1_name")
+        library2 = self._dummy_library(sigel="lib2", name=u"ALLINGSÅS BIBLIOTEK")
+        survey1_2013 = self._dummy_survey(sample_year=2013, library=library1, publish=True)
+        survey1_2014 = self._dummy_survey(sample_year=2014, library=library1, publish=True)
+        survey1_2015 = self._dummy_survey(sample_year=2015, library=library1)
+        survey2_2014 = self._dummy_survey(sample_year=2014, library=library2, publish=True)
+        survey2_2015 = self._dummy_survey(sample_year=2015,
+                                          library=self._dummy_library(sigel="lib3", name=u"Allingsås bibliotek"))
+        survey3_2015 = self._dummy_survey(sample_year=2015)
+
+        lineages = Survey.previous_years_survey_ids([survey1_2015, survey2_2015, survey3_2015], years=2)
+
+        self.assertEqual(lineages, [[survey1_2014.pk, survey1_2013.pk], [survey2_2014.pk], []])
+
+    def test_previous_years_survey_ids_agrees_with_previous_years_survey(self):
+        previous_years_survey = self._dummy_survey(sample_year=2014,
+                                                   library=self._dummy_library(sigel="lib1",
+                                                                               name="previous_name"))
+        this_years_survey = self._dummy_survey(sample_year=2015,
+                                               library=self._dummy_library(sigel="lib1",
+                                                                           name="new_name"))
+
+        self.assertEqual(Survey.previous_years_survey_ids([this_years_survey]), [[]])
+
+        previous_years_survey.publish()
+
+        self.assertEqual(Survey.previous_years_survey_ids([this_years_survey]), [[previous_years_survey.pk]])
+        self.assertEqual(this_years_survey.previous_years_survey().pk, previous_years_survey.pk)
+
     def test_returns_previous_years_value_if_same_variable_both_years(self):
         variable = self._dummy_variable()
         library = self._dummy_library()
@@ -1059,6 +1089,103 @@ class TestSurveyReporting(MongoTestCase):
         self.assertTrue(survey2.is_reporting_for_others())
 
 
+class TestCoReportingGraph(MongoTestCase):
+    def test_is_shared_by_the_surveys_of_a_year(self):
+        first_survey = self._dummy_survey(library=self._dummy_library(sigel="1"), sample_year=2014,
+                                          selected_libraries=["1", "2"])
+        second_survey = self._dummy_survey(library=self._dummy_library(sigel="2"), sample_year=2014,
+                                           selected_libraries=["2"])
+        third_survey = self._dummy_survey(library=self._dummy_library(sigel="3"), sample_year=2014)
+
+        graph = CoReportingGraph(2014)
+
+        self.assertTrue(first_survey.has_conflicts(graph))
+        self.assertListEqual(first_survey.get_conflicting_surveys(graph), [second_survey])
+        self.assertEqual(second_survey.reported_by(graph), ["1", "2"])
+        self.assertTrue(second_survey.is_reported_by_other(graph))
+        self.assertFalse(third_survey.is_reported_by_other(graph))
+
+    def test_finds_surveys_co_reported_by_other(self):
+        reported = self._dummy_survey(library=self._dummy_library(sigel="1"), sample_year=2014)
+        reporting = self._dummy_survey(library=self._dummy_library(sigel="2"), sample_year=2014,
+                                       selected_libraries=["1", "2"])
+        alone = self._dummy_survey(library=self._dummy_library(sigel="3"), sample_year=2014)
+
+        graph = CoReportingGraph(2014)
+
+        self.assertTrue(graph.is_co_reported_by_other(reported))
+        self.assertFalse(graph.is_co_reported_by_other(reporting))
+        self.assertFalse(graph.is_co_reported_by_other(alone))
+
+    def test_is_not_used_for_surveys_of_other_years(self):
+        survey = self._dummy_survey(library=self._dummy_library(sigel="1"), sample_year=2014)
+        self._dummy_survey(library=self._dummy_library(sigel="2"), sample_year=2014, selected_libraries=["1"])
+
+        self.assertTrue(survey.is_reported_by_other(CoReportingGraph(2013)))
+
+
+class TestStoredCoReporting(MongoTestCase):
+    def test_stores_co_reporting_of_saved_survey(self):
+        reported = self._dummy_survey(library=self._dummy_library(sigel="X"), selected_libraries=[])
+        reporting = self._dummy_survey(library=self._dummy_library(sigel="Z"), selected_libraries=["Z", "X"])
+
+        reported.reload()
+        self.assertEqual(reported._reported_by, ["Z"])
+        self.assertTrue(reported._is_reported_by_other)
+        self.assertTrue(reporting._is_reporting_for_others)
+        self.assertFalse(reporting._is_reported_by_other)
+
+    def test_updates_other_surveys_when_selection_changes(self):
+        reported = self._dummy_survey(library=self._dummy_library(sigel="X"), selected_libraries=[])
+        reporting = self._dummy_survey(library=self._dummy_library(sigel="Z"), selected_libraries=["Z", "X"])
+
+        reporting.selected_libraries = ["Z"]
+        reporting.save()
+
+        reported.reload()
+        self.assertEqual(reported._reported_by, [])
+        self.assertFalse(reported._is_reported_by_other)
+        self.assertFalse(reporting._is_reporting_for_others)
+
+    def test_stores_conflicts_of_both_surveys(self):
+        first = self._dummy_survey(library=self._dummy_library(sigel="1"), selected_libraries=["1", "2"])
+        second = self._dummy_survey(library=self._dummy_library(sigel="2"), selected_libraries=["2"])
+
+        first.reload()
+        self.assertTrue(first._has_conflict)
+        self.assertTrue(second._has_conflict)
+
+    def test_updates_other_surveys_when_survey_is_deleted(self):
+        reported = self._dummy_survey(library=self._dummy_library(sigel="X"), selected_libraries=[])
+        reporting = self._dummy_survey(library=self._dummy_library(sigel="Z"), selected_libraries=["Z", "X"])
+
+        reporting.delete()
+
+        reported.reload()
+        self.assertFalse(reported._is_reported_by_other)
+
+    def test_excludes_co_reported_surveys_in_order(self):
+        self._dummy_survey(library=self._dummy_library(name="c", sigel="X"), sample_year=2014,
+                           selected_libraries=[])
+        self._dummy_survey(library=self._dummy_library(name="b", sigel="Z"), sample_year=2014,
+                           selected_libraries=["Z", "X"])
+        self._dummy_survey(library=self._dummy_library(name="a", sigel="Y"), sample_year=2014)
+
+        surveys = Survey.objects.by(sample_year=2014, exclude_co_reported_by_other=True)
+
+        self.assertEqual([survey.library.name for survey in surveys], ["a", "b"])
+
+    def test_counts_surveys_by_library_type_and_status(self):
+        self._dummy_survey(library=self._dummy_library(sigel="X", library_type="folkbib"), sample_year=2014,
+                           selected_libraries=[])
+        self._dummy_survey(library=self._dummy_library(sigel="Z", library_type="folkbib"), sample_year=2014,
+                           selected_libraries=["Z", "X"])
+
+        counts = Survey.objects.filter(sample_year=2014).counts_by_library_type_and_status()
+
+        self.assertEqual(counts, {("folkbib", "not_viewed"): (2, 1)})
+
+
 class TestLockSurvey(MongoTestCase):
     def test_creates_a_lock(self):
         survey = self._dummy_survey()
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import Variable, Generation, VariableRegistry, variable_registry
+
+
+class TestVariableRegistry(MongoTestCase):
+    def test_returns_variable_by_key_and_by_id(self):
+        variable = self._dummy_variable(key=u"key1")
+
+        self.assertEqual(variable_registry.get(u"key1").id, variable.id)
+        self.assertEqual(variable_registry.get_by_id(variable.id).key, u"key1")
+        self.assertEqual(variable_registry.get_by_id(str(variable.id)).key, u"key1")
+
+    def test_returns_none_for_unknown_key(self):
+        self.assertEqual(variable_registry.get(u"does_not_exist"), None)
+
+    def test_returns_all_variables_ordered_by_key(self):
+        self._dummy_variable(key=u"b")
+        self._dummy_variable(key=u"a")
+
+        self.assertEqual([variable.key for variable in variable_registry.all()], [u"a", u"b"])
+
+    def test_reloads_when_variable_is_saved(self):
+        variable = self._dummy_variable(key=u"key1", description=u"old description")
+        self.assertEqual(variable_registry.get(u"key1").description, u"old description")
+
+        variable.description = u"new description"
+        variable.save()
+
+        self.assertEqual(variable_registry.get(u"key1").description, u"new description")
+
+    def test_reloads_when_variable_is_deleted(self):
+        variable = self._dummy_variable(key=u"key1")
+        self.assertNotEqual(variable_registry.get(u"key1"), None)
+
+        variable.delete()
+
+        self.assertEqual(variable_registry.get(u"key1"), None)
+
+    def test_reloads_when_generation_is_bumped_by_another_process(self):
+        registry = VariableRegistry()
+        self._dummy_variable(key=u"key1", description=u"old description")
+        self.assertEqual(registry.get(u"key1").description, u"old description")
+
+        Variable.objects(key=u"key1").update(set__description=u"new description")
+        self.assertEqual(registry.get(u"key1").description, u"old description")
+
+        Generation.bump(VariableRegistry.GENERATION)
+        registry._checked_at = 0
+
+        self.assertEqual(registry.get(u"key1").description, u"new description")
+
+    def test_resolves_replacements_to_registry_instances(self):
+        replaced = self._dummy_variable(key=u"old_key")
+        replacement = self._dummy_variable(key=u"new_key")
+        replacement.replace_siblings([replaced.id], commit=True)
+
+        self.assertTrue(variable_registry.get(u"new_key").replaces[0] is variable_registry.get(u"old_key"))
+        self.assertTrue(variable_registry.get(u"old_key").replaced_by is variable_registry.get(u"new_key"))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import tempfile
+
+from django.test.utils import override_settings
+
+from libstat.tests import MongoTestCase
+from libstat.models import Artifact
+from libstat.services.artifact_store import store_artifact, open_artifact, backends
+
+
+class TestArtifactStore(MongoTestCase):
+    def _store(self, generation, content):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(content)
+        return store_artifact(u"kind", 2014, generation, f.name)
+
+    def _test_stores_content_and_metadata(self):
+        artifact = self._store(1, "content")
+
+        self.assertEqual(open_artifact(artifact).read(), "content")
+        self.assertEqual(artifact.size, 7)
+        self.assertEqual(artifact.checksum, hashlib.sha1("content").hexdigest())
+        self.assertEqual(Artifact.current(u"kind", 2014).id, artifact.id)
+        backends[artifact.backend].delete(artifact.location)
+
+    @override_settings(ARTIFACT_STORE="local")
+    def test_stores_content_and_metadata_on_local_disk(self):
+        self._test_stores_content_and_metadata()
+
+    @override_settings(ARTIFACT_STORE="gridfs")
+    def test_stores_content_and_metadata_in_gridfs(self):
+        self._test_stores_content_and_metadata()
+
+    @override_settings(ARTIFACT_STORE="gridfs")
+    def test_keeps_only_the_replaced_artifact_of_older_generations(self):
+        first = self._store(1, "first")
+        second = self._store(2, "second")
+        third = self._store(3, "third")
+
+        self.assertEqual([artifact.id for artifact in Artifact.objects.order_by("generation")],
+                         [second.id, third.id])
+        self.assertRaises(Exception, lambda: open_artifact(first).read())
+        self.assertEqual(open_artifact(second).read(), "second")
+
+    @override_settings(ARTIFACT_STORE="gridfs")
+    def test_keeps_file_replaced_in_same_generation_while_it_is_read(self):
+        first = self._store(1, "first")
+        reading = open_artifact(first)
+
+        self.assertEqual(self._store(1, "first").location, first.location)
+        second = self._store(1, "second")
+
+        self.assertEqual(reading.read(), "first")
+        self.assertEqual(Artifact.current(u"kind", 2014).location, second.location)
+        self.assertEqual(open_artifact(second).read(), "second")
+
+        self._store(2, "third")
+        self._store(3, "fourth")
+        self.assertRaises(Exception, lambda: open_artifact(first).read())
+        self.assertRaises(Exception, lambda: open_artifact(second).read())
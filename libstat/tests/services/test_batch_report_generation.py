@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import CachedReport
+from libstat.report_templates import report_template_base
+from libstat.services.report_generation import get_report
+from libstat.services.batch_report_generation import ReportBatch
+
+
+class TestReportBatch(MongoTestCase):
+    def setUp(self):
+        self.variables = [self._dummy_variable(key=key, target_groups=["folkbib", "skolbib"])
+                          for key in report_template_base().all_variable_keys]
+
+    def _survey(self, sample_year, library, values):
+        return self._dummy_survey(sample_year=sample_year, library=library, publish=True, observations=[
+            self._dummy_observation(variable=variable, value=value) for variable, value in zip(self.variables, values)
+        ])
+
+    def test_generates_same_reports_as_get_report(self):
+        library1 = self._dummy_library(name=u"Library 1", sigel="sigel1", municipality_code=u"0180")
+        library2 = self._dummy_library(name=u"Library 2", sigel="sigel2", municipality_code=u"0180", library_type="skolbib")
+        library3 = self._dummy_library(name=u"Library 3", sigel="sigel3", municipality_code=u"0127")
+        surveys = [
+            self._survey(2016, library1, [1, 2, 0, 5, u"3"] * 40),
+            self._survey(2016, library2, [3, 0, 7, u"-", 1] * 40),
+            self._survey(2016, library3, [4, 4, 1, 2] * 50),
+        ]
+        self._survey(2015, library1, [2, 2, 0, 1, 9] * 40)
+        self._survey(2014, library3, [0, 5, 5] * 60)
+
+        selections = [(u"0180", None), (u"0180", u"kommun"), (u"0100", None), (None, None), (u"0127", None)]
+        reports = ReportBatch(2016).generate(selections)
+
+        for selection, selected_surveys in [((u"0180", None), surveys[0:2]),
+                                            ((u"0100", None), surveys),
+                                            ((None, None), surveys),
+                                            ((u"0127", None), surveys[2:3])]:
+            report = get_report(selected_surveys, 2016)
+            self.assertEqual(reports[selection]["measurements"], report["measurements"])
+            self.assertEqual(reports[selection]["libraries"], report["libraries"])
+
+    def test_reads_previous_years_from_predecessors_of_selected_surveys(self):
+        library1 = self._dummy_library(name=u"Library 1", sigel="sigel1", municipality_code=u"0180")
+        library2 = self._dummy_library(name=u"Library 2", sigel="sigel2", municipality_code=u"0180")
+        library3 = self._dummy_library(name=u"Library 3", sigel="sigel3", municipality_code=u"0180")
+        # Library 2 left the municipality after 2015 and library 3 joined it in 2016
+        surveys = [self._survey(2016, library1, [1, 2] * 100), self._survey(2016, library3, [3, 4] * 100)]
+        self._survey(2015, library1, [5, 6] * 100)
+        self._survey(2015, library2, [7, 8] * 100)
+        self._survey(2014, library2, [9, 10] * 100)
+
+        batch = ReportBatch(2016)
+        reports = batch.generate([(u"0180", None)])
+
+        report = get_report(surveys, 2016)
+        self.assertEqual(reports[(u"0180", None)]["measurements"], report["measurements"])
+        self.assertEqual(sorted(batch.dependencies_for((u"0180", None))),
+                         sorted(CachedReport.objects.get(surveys__all=surveys).dependencies))
+
+    def test_leaves_out_selections_without_published_surveys(self):
+        self._survey(2016, self._dummy_library(municipality_code=u"0180"), [1])
+
+        reports = ReportBatch(2016).generate([(u"0180", None), (u"0127", None)])
+
+        self.assertEqual(reports.keys(), [(u"0180", None)])
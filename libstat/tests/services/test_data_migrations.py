@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import Survey, NationalTotal, StatisticsCell
+from libstat.services.data_migrations import migrate, MIGRATIONS
+
+
+class TestDataMigrations(MongoTestCase):
+    def test_stores_co_reporting_of_surveys_saved_before_it_was_stored(self):
+        reported = self._dummy_survey(library=self._dummy_library(sigel="X"), selected_libraries=[])
+        self._dummy_survey(library=self._dummy_library(sigel="Z"), selected_libraries=["Z", "X"])
+        Survey._get_collection().update({}, {"$unset": {"_reported_by": 1, "_is_reported_by_other": 1}}, multi=True)
+
+        migrate()
+
+        reported.reload()
+        self.assertEqual(reported._reported_by, ["Z"])
+        self.assertTrue(reported._is_reported_by_other)
+
+    def test_builds_national_totals_of_data_published_before_they_were_kept(self):
+        variable = self._dummy_variable(key=u"key1")
+        self._dummy_survey(sample_year=2016, publish=True,
+                           observations=[self._dummy_observation(variable=variable, value=5)])
+        NationalTotal.objects.delete()
+
+        migrate()
+
+        self.assertEqual(NationalTotal.totals(2016, [u"key1"]), {u"key1": 5.0})
+
+    def test_builds_statistics_cube_of_surveys_published_before_it_was_kept(self):
+        self._dummy_survey(sample_year=2016, publish=True, library=self._dummy_library(municipality_code=u"0180"))
+        StatisticsCell.objects.delete()
+
+        migrate()
+
+        self.assertEqual(StatisticsCell.objects.get(sample_year=2016, variable_key=None).count, 1)
+
+    def test_runs_each_migration_once(self):
+        self.assertEqual(migrate(), len(MIGRATIONS))
+        self.assertEqual(migrate(), 0)
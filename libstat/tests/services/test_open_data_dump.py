@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import json
+
+from django.test.utils import override_settings
+
+from libstat.tests import MongoTestCase
+from libstat.models import Artifact, Generation, OpenData
+from libstat.services.artifact_store import open_artifact
+from libstat.services.open_data_dump import dump_artifact, dump_kind
+
+
+@override_settings(ARTIFACT_STORE="gridfs")
+class TestOpenDataDump(MongoTestCase):
+    def _lines(self, year, dump_format):
+        return gzip.GzipFile(fileobj=open_artifact(dump_artifact(year, dump_format)), mode="rb").read().splitlines()
+
+    def test_writes_active_open_data_of_year_as_ndjson(self):
+        variable = self._dummy_variable(key=u"folk1")
+        self._dummy_open_data(variable=variable, sample_year=2014, sigel="sigel1", library_name=u"Bibliotek å",
+                              value=5)
+        self._dummy_open_data(variable=variable, sample_year=2014, is_active=False)
+        self._dummy_open_data(variable=variable, sample_year=2013)
+
+        rows = [json.loads(line) for line in self._lines(2014, "ndjson")]
+
+        self.assertEqual(rows, [{u"variable_key": u"folk1", u"sigel": u"sigel1", u"library_name": u"Bibliotek å",
+                                 u"target_group": u"folkbib", u"value": 5}])
+
+    def test_writes_csv_with_header(self):
+        self._dummy_open_data(variable=self._dummy_variable(key=u"folk1"), sample_year=2014, sigel="sigel1",
+                              library_name=u"Bibliotek å", value=u"okänt")
+
+        rows = list(csv.reader(self._lines(2014, "csv")))
+
+        self.assertEqual(rows, [["variable_key", "sigel", "library_name", "target_group", "value"],
+                                ["folk1", "sigel1", u"Bibliotek å".encode("utf-8"), "folkbib",
+                                 u"okänt".encode("utf-8")]])
+
+    def test_rewrites_dump_when_year_is_published_to(self):
+        self._dummy_open_data(sample_year=2014)
+        artifact = dump_artifact(2014, "ndjson")
+
+        self.assertEqual(dump_artifact(2014, "ndjson").id, artifact.id)
+
+        self._dummy_open_data(sample_year=2014)
+        Generation.bump(OpenData.year_generation(2014))
+        new_artifact = dump_artifact(2014, "ndjson")
+
+        self.assertEqual(new_artifact.generation, artifact.generation + 1)
+        self.assertEqual(Artifact.current(dump_kind("ndjson"), 2014).id, new_artifact.id)
+        self.assertEqual(len(self._lines(2014, "ndjson")), 2)
+
+    def test_writes_long_free_text_answers(self):
+        comment = u"ö" * 2000
+        self._dummy_survey(sample_year=2014, publish=True, observations=[
+            self._dummy_observation(variable=self._dummy_variable(key=u"kommentar", type="string"), value=comment)])
+
+        rows = [json.loads(line) for line in self._lines(2014, "ndjson")]
+
+        self.assertEqual([row[u"value"] for row in rows], [comment])
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from django.test.utils import override_settings
+
+from libstat.tests import MongoTestCase
+from libstat.models import Generation, OpenData
+from libstat.services.excel_export import public_export_artifact, write_public_export
+
+
+@override_settings(ARTIFACT_STORE="gridfs")
+class TestPublicExport(MongoTestCase):
+    def _publish(self, year):
+        self._dummy_survey(sample_year=year, publish=True,
+                           observations=[self._dummy_observation(variable=self._dummy_variable(), value=1)])
+
+    def test_writes_export_of_year_without_export_in_request(self):
+        self._publish(2014)
+
+        artifact = public_export_artifact(2014)
+
+        self.assertEqual(artifact.generation, Generation.current(OpenData.year_generation(2014)))
+        self.assertTrue(artifact.size > 0)
+
+    def test_publishing_a_year_keeps_exports_of_other_years(self):
+        self._publish(2014)
+        self._publish(2015)
+        artifact_2014 = write_public_export(2014)
+        write_public_export(2015)
+
+        self._publish(2015)
+        write_public_export(2015)
+
+        self.assertEqual(public_export_artifact(2014).id, artifact_2014.id)
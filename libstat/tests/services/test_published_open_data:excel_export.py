@@ -1,4 +1,8 @@
 # -*- coding: UTF-8 -*-
+import tempfile
+
+from openpyxl import load_workbook
+
 from libstat.services.excel_export import _published_open_data_as_workbook
 
 from libstat.tests import MongoTestCase
@@ -21,7 +25,9 @@ class TestSurveysExport(MongoTestCase):
         survey1 = self._dummy_survey(library=library1)
         survey1.publish()
 
-        worksheet = _published_open_data_as_workbook(2001)
+        with tempfile.NamedTemporaryFile(suffix=".xlsx") as f:
+            _published_open_data_as_workbook(2001).save(f.name)
+            worksheet = load_workbook(f.name).worksheets[0]
 
         self.assertEquals(worksheet["A1"].value, "Bibliotek")
         self.assertEquals(worksheet["B1"].value, "Sigel")
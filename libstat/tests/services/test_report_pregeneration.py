@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from libstat.tests import MongoTestCase
+from libstat.models import CachedReport, Survey
+from libstat.services.report_generation import get_report, report_memory_cache
+from libstat.services.report_pregeneration import standard_selections, pregenerate_reports, \
+    published_years_changed_since
+
+
+class TestReportPregeneration(MongoTestCase):
+    def setUp(self):
+        report_memory_cache.clear()
+
+    def test_lists_municipalities_counties_principals_and_whole_country(self):
+        self._dummy_survey(sample_year=2016, publish=True, library=self._dummy_library(municipality_code=u"0180"))
+        self._dummy_survey(sample_year=2016, publish=True,
+                           library=self._dummy_library(municipality_code=u"0127", library_type=u"sjukbib"))
+        self._dummy_survey(sample_year=2015, publish=True, library=self._dummy_library(municipality_code=u"0114"))
+
+        self.assertEqual(standard_selections(2016), [
+            (u"0127", None), (u"0180", None), (u"0100", None),
+            (None, u"kommun"), (None, u"landsting"), (None, None)
+        ])
+
+    def test_lists_no_selections_for_year_without_published_surveys(self):
+        self.assertEqual(standard_selections(2016), [])
+
+    def test_caches_reports_that_get_report_returns(self):
+        self._dummy_survey(sample_year=2016, publish=True, library=self._dummy_library(municipality_code=u"0180"))
+        self._dummy_survey(sample_year=2016, publish=True, library=self._dummy_library(municipality_code=u"0127"))
+        progress = []
+
+        num_reports = pregenerate_reports(2016, progress=lambda *args: progress.append(args))
+
+        self.assertEqual(num_reports, 5)
+        # The county, the principal and the whole country all consist of the same two surveys
+        self.assertEqual(CachedReport.objects.count(), 3)
+        self.assertEqual([(done, total) for done, total, selection, number_of_surveys, seconds in progress],
+                         [(1, 5), (2, 5), (3, 5), (4, 5), (5, 5)])
+        surveys = list(Survey.objects.filter(sample_year=2016, library__municipality_code=u"0180"))
+        cached_report = CachedReport.objects.get(surveys__all=surveys, surveys__size=1)
+        self.assertEqual(get_report(surveys, 2016)["id"], cached_report.report["id"])
+
+    def test_caches_reports_under_key_of_report_view_request(self):
+        library1 = self._dummy_library(name=u"Library 1", sigel="sigel1", municipality_code=u"0180")
+        library2 = self._dummy_library(name=u"Library 2", sigel="sigel2", municipality_code=u"0180")
+        self._dummy_survey(sample_year=2016, publish=True, library=library1, selected_libraries=["sigel1", "sigel2"])
+        self._dummy_survey(sample_year=2016, publish=True, library=library2, selected_libraries=[])
+        self._dummy_survey(sample_year=2016, publish=True, library=self._dummy_library(municipality_code=u"0127"))
+        pregenerate_reports(2016)
+        report_memory_cache.clear()
+
+        surveys = self._get("reports", params={"sample_year": "2016", "municipality_code": "0180"}).context["surveys"]
+        response = self._post("report", data={
+            "sample_year": "2016",
+            "surveys": [survey.library.sigel for survey in surveys],
+            "number_of_sigel_choices": "2",
+            "municipality_code": "0180"
+        })
+
+        cached_report = CachedReport.objects.get(surveys__all=surveys, surveys__size=2)
+        self.assertEqual(response.context["id"], cached_report.report["id"])
+
+    def test_returns_years_published_to_since_last_check(self):
+        generations = {}
+        self._dummy_survey(sample_year=2015, publish=True)
+        self.assertEqual(published_years_changed_since(generations), [2015])
+
+        self._dummy_survey(sample_year=2016, publish=True)
+        self.assertEqual(published_years_changed_since(generations), [2016])
+        self.assertEqual(published_years_changed_since(generations), [])
@@ -8,7 +8,7 @@ from django.utils.http import is_safe_url
 from data.municipalities import municipalities, get_counties
 from data.principals import principal_for_library_type, name_for_principal, library_types_for_principal
 from libstat.models import Survey
-from libstat.services.report_generation import get_report
+from libstat.services.report_generation import get_report, report_surveys
 
 
 def report(request):
@@ -25,7 +25,7 @@ def report(request):
     municipality_code = request.POST.get("municipality_code", None)
     principal = request.POST.get("principal", None)
 
-    surveys = list(Survey.objects.filter(_status=u"published", sample_year=sample_year, library__sigel__in=sigels))
+    surveys = list(report_surveys(sample_year, sigels))
 
     context = get_report(surveys, sample_year)
     context["previous_url"] = previous_url
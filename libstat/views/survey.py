@@ -12,7 +12,7 @@ from django.forms.util import ErrorList
 
 from bibstat import settings
 
-from libstat.models import Survey, Variable, SurveyObservation, Library, SurveyEditingLock
+from libstat.models import Survey, SurveyObservation, Library, SurveyEditingLock, variable_registry
 from libstat.forms.survey import SurveyForm
 from libstat.survey_templates import survey_template
 
@@ -37,7 +37,7 @@ def example_survey(request):
                 address=u"Exempelgatan 14B",
                 library_type=u"folkbib"
             ),
-            observations=[SurveyObservation(variable=Variable.objects.get(key=cell.variable_key))
+            observations=[SurveyObservation(variable=variable_registry.get(cell.variable_key))
                           for cell in survey_template(sample_year).cells])),
     }
     return render(request, 'libstat/survey.html', context)
@@ -64,15 +64,13 @@ def _save_survey_response_from_form(survey, form):
         submit_action = form.cleaned_data.pop("submit_action", None)
         altered_fields = form.cleaned_data.pop("altered_fields", None).split(" ")
 
-        variables = Variable.objects.all().only('key')
-        all_variable_keys = [var.key for var in variables]
-
         for field in form.cleaned_data:
             value = form.cleaned_data[field]
             if type(value) == "str":
                 value = value.strip()
-            if field in all_variable_keys:
-                variable_type = Variable.objects.filter(key=field).first().type
+            variable = variable_registry.get(field)
+            if variable:
+                variable_type = variable.type
                 if variable_type == "integer" and value != "" and value != "-":
                     # spaces are used as thousands separators
                     value = int(value.replace(" ", ""))
@@ -16,8 +16,8 @@ from bibstat import settings
 from libstat import utils
 from libstat.services.bibdb_integration import fetch_libraries
 from libstat.services.clean_data import remove_empty_surveys, match_libraries_and_replace_sigel
-from libstat.models import Survey, SurveyObservation, Variable
-from libstat.services.excel_export import surveys_to_excel_workbook, public_excel_workbook
+from libstat.models import Survey, SurveyObservation, Variable, CoReportingGraphs
+from libstat.services.excel_export import surveys_to_excel_workbook
 from libstat.survey_templates import survey_template
 from data.municipalities import municipalities
 
@@ -184,42 +184,25 @@ def surveys_overview(request, sample_year):
         table[0].append(status[1])
     table[0].append("Total")
 
-    # Preload surveys from database
-    all_active_surveys = list(Survey.objects.filter(is_active=True, sample_year=sample_year))
-    all_active_non_coreported_surveys = list(Survey.objects.by(is_active=True, sample_year=sample_year, exclude_co_reported_by_other=True)) # Using SurveyQuerySet
+    # (all, without the surveys co-reported by another survey) per library type and status
+    counts = Survey.objects.filter(is_active=True, sample_year=int(sample_year)).counts_by_library_type_and_status()
+
+    def count(library_type=None, status=None):
+        matching = [value for (t, s), value in counts.iteritems()
+                    if (library_type is None or t == library_type) and (status is None or s == status)]
+        return '%d (%d)' % (sum(c for a, c in matching), sum(a for a, c in matching))
 
     for library_type in utils.SURVEY_TARGET_GROUPS:
         row = [library_type[1]]
-        library_type_value = library_type[0]
         for status in Survey.STATUSES:
-            status_value = status[0]
-            surveys = [s for s in all_active_surveys if s._status == status_value and s.library.library_type == library_type_value]
-            surveys_all_count = len(surveys)
-            surveys_non_coreporting = [s for s in all_active_non_coreported_surveys if s._status == status_value and s.library.library_type == library_type_value]
-            surveys_non_coreporting_count = len(surveys_non_coreporting)
-            row.append('%d (%d)' % (surveys_non_coreporting_count, surveys_all_count))
-
-        surveys_total_status = [s for s in all_active_surveys if s.library.library_type == library_type_value]
-        surveys_total_status_all_count = len(surveys_total_status)
-        surveys_total_status_non_coreporting = [s for s in all_active_non_coreported_surveys if s.library.library_type == library_type_value]
-        surveys_total_status_all_non_coreporting_count = len(surveys_total_status_non_coreporting)
-        row.append('%d (%d)' % (surveys_total_status_all_non_coreporting_count, surveys_total_status_all_count))
-
+            row.append(count(library_type[0], status[0]))
+        row.append(count(library_type[0]))
         table.append(row)
 
     row = ["Total"]
     for status in Survey.STATUSES:
-        status_value_str = status[0]
-        surveys_total = [s for s in all_active_surveys if s._status == status_value_str]
-        surveys_total_all_count = len(surveys_total)
-        surveys_total_non_coreporting = [s for s in all_active_non_coreported_surveys if s._status == status_value_str]
-        surveys_total_all_non_coreporting_count = len(surveys_total_non_coreporting)
-        row.append('%d (%d)' % (surveys_total_all_non_coreporting_count, surveys_total_all_count))
-
-    surveys_total_total_all_count = len(all_active_surveys)
-    surveys_total_total_all_non_coreporting_count = len(all_active_non_coreported_surveys)
-    row.append('%d (%d)' % (surveys_total_total_all_non_coreporting_count, surveys_total_total_all_count))
-
+        row.append(count(status=status[0]))
+    row.append(count())
     table.append(row)
 
     context = {
@@ -237,8 +220,10 @@ def surveys_statuses(request):
     survey_response_ids = request.POST.getlist("survey-response-ids", [])
     if status == "published":
         num_successful_published = 0
+        # Publishing does not change who reports for which library
+        co_reporting_graphs = CoReportingGraphs()
         for survey in Survey.objects.filter(id__in=survey_response_ids):
-            successful = survey.publish()
+            successful = survey.publish(co_reporting_graphs[survey.sample_year])
             if successful:
                 num_successful_published += 1
         message = u"Publicerade {} stycken enkäter.".format(num_successful_published)